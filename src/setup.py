@@ -33,8 +33,12 @@ setup(name='stopover-server',
           'falcon >= 3.1.1, < 4.0.0',
           'bjoern >= 3.2.2, < 4.0.0',
       ],
+      extras_require={
+          'asgi': ['uvicorn >= 0.20.0, < 1.0.0'],
+      },
       entry_points={
           'console_scripts': [
               'stopover = stopover_server.__main__:main',
+              'stopover-bench = stopover_server.bench:main',
           ],
       })
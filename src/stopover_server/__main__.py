@@ -2,7 +2,12 @@
 # -*- coding: utf-8 -*-
 
 from .version import __version__
-from .broker import Broker
+from .broker import Broker, SERVER, DEFAULT_SERVER
+from .metrics import MetricsResource
+from .tcp import FrameServer
+from .wsgi import ThreadingWSGIServer, QuietWSGIRequestHandler
+from threading import Thread
+from wsgiref.simple_server import make_server
 import falcon
 import logging
 import yaml
@@ -39,6 +44,66 @@ logging.basicConfig(
 )
 
 
+def get_server(config) -> str:
+    return config['global']['server'] if 'server' in config['global'] \
+        else DEFAULT_SERVER
+
+
+def create_broker(config) -> Broker:
+    processes = config['global']['processes'] \
+        if 'processes' in config['global'] else 1
+
+    if processes > 1:
+        # Calls to the workers block the thread that makes them, so they
+        # only run in parallel behind a multi-threaded server
+        if get_server(config) not in (SERVER.THREADED, SERVER.ASGI):
+            logging.critical(
+                'running more than one process requires '
+                'the threaded or asgi server'
+            )
+            sys.exit(1)
+
+        from .cluster import Cluster
+        return Broker(config, cluster=Cluster.start(config, processes))
+
+    return Broker(config)
+
+
+def start_tcp_server(config, broker: Broker):
+    if 'tcp_port' not in config['global']:
+        return
+
+    tcp_port = config['global']['tcp_port']
+    server = FrameServer(('0.0.0.0', tcp_port), broker)
+    Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f'listening for TCP frames on port {tcp_port}')
+
+
+def run_asgi(config, port):
+    try:
+        import uvicorn
+    except ImportError:
+        logging.critical('the asgi server requires uvicorn')
+        sys.exit(1)
+
+    import falcon.asgi
+    from .asgi import AsyncBroker, AsyncMetricsResource
+
+    executor_workers = config['global']['executor_workers'] \
+        if 'executor_workers' in config['global'] else None
+
+    broker = create_broker(config)
+    start_tcp_server(config, broker)
+
+    async_broker = AsyncBroker(broker, executor_workers)
+
+    api = falcon.asgi.App(cors_enable=True)
+    api.add_route('/', async_broker)
+    api.add_route('/metrics', AsyncMetricsResource(async_broker))
+
+    uvicorn.run(api, host='0.0.0.0', port=port, log_level='warning')
+
+
 def main():
     logging.info(f'\n{banner}')
 
@@ -52,11 +117,37 @@ def main():
         logging.critical('the streams dir is not active')
         sys.exit(1)
 
+    port = config['global']['port'] if 'port' in config['global'] else 5704
+    server = get_server(config)
+
+    if server == SERVER.ASGI:
+        run_asgi(config, port)
+        return
+
+    broker = create_broker(config)
+    start_tcp_server(config, broker)
+
     api = falcon.App(cors_enable=True)
-    api.add_route('/', Broker(config))
+    api.add_route('/', broker)
+    api.add_route('/metrics', MetricsResource(broker))
 
-    port = config['global']['port'] if 'port' in config['global'] else 5704
-    bjoern.run(api, '0.0.0.0', port)
+    if server == SERVER.BJOERN:
+        bjoern.run(api, '0.0.0.0', port)
+
+    # One thread per connection, so that long-polling consumers do not
+    # block the rest of the clients
+    elif server == SERVER.THREADED:
+        make_server(
+            '0.0.0.0',
+            port,
+            api,
+            server_class=ThreadingWSGIServer,
+            handler_class=QuietWSGIRequestHandler,
+        ).serve_forever()
+
+    else:
+        logging.critical(f'unknown server "{server}"')
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from .broker import Broker
+from .metrics import MetricsResource
+from .streaming import MessageStream
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+
+DEFAULT_EXECUTOR_WORKERS = 32
+
+
+class BlockingStream:
+    # Reads the body of an ASGI request from an executor thread
+
+    def __init__(self, stream, loop: asyncio.AbstractEventLoop):
+        self.stream = stream
+        self.loop = loop
+
+    def read(self, size: int = None) -> bytes:
+        if size is not None and size < 0:
+            size = None
+        return asyncio.run_coroutine_threadsafe(
+            self.stream.read(size),
+            self.loop,
+        ).result()
+
+
+class AsyncBroker:
+
+    def __init__(self, broker: Broker, executor_workers: int = None):
+        if executor_workers is None:
+            executor_workers = DEFAULT_EXECUTOR_WORKERS
+
+        self.broker = broker
+
+        # RocksDB calls block, so they never run in the event loop
+        self.executor = ThreadPoolExecutor(
+            max_workers=executor_workers,
+            thread_name_prefix='broker',
+        )
+
+    async def on_get(self, request, response):
+        Broker.on_get(request, response)
+
+    async def on_post(self, request, response):
+        headers = {
+            key.lower(): value
+            for (key, value) in request.headers.items()
+        }
+
+        status = self.broker.authenticate(headers)
+        if status is not None:
+            response.status = status
+            return
+
+        # The body is read while it is being decoded and written
+        loop = asyncio.get_running_loop()
+        response.status, data = await loop.run_in_executor(
+            self.executor,
+            self.broker.handle_body,
+            BlockingStream(request.stream, loop),
+            request.content_length,
+        )
+
+        if isinstance(data, MessageStream):
+            response.content_type = data.content_type
+            response.stream = self._iter_chunks(data)
+        else:
+            response.data = data
+
+    async def _iter_chunks(self, message_stream: MessageStream):
+        # Every chunk is read from the partitions in the executor
+        loop = asyncio.get_running_loop()
+        chunks = iter(message_stream)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(
+                    self.executor,
+                    next,
+                    chunks,
+                    None,
+                )
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            await loop.run_in_executor(self.executor, message_stream.close)
+
+
+class AsyncMetricsResource:
+
+    def __init__(self, async_broker: AsyncBroker):
+        self.executor = async_broker.executor
+        self.metrics_resource = MetricsResource(async_broker.broker)
+
+    async def on_get(self, request, response):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.executor,
+            self.metrics_resource.on_get,
+            request,
+            response,
+        )
@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from .wsgi import ThreadingWSGIServer, QuietWSGIRequestHandler
+from .broker import Broker, SERVER, STATUS
+from .partition import Partition, PartitionItem
+from . import utils
+from http.client import HTTPConnection
+from threading import Lock, Thread
+from wsgiref.simple_server import make_server
+from typing import Dict, List, Union
+import argparse
+import tempfile
+import logging
+import random
+import shutil
+import falcon
+import time
+import json
+import os
+
+
+class Recorder:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.latencies = {}
+        self.counts = {}
+
+    def record(self, name: str, seconds: float, count: int = 1):
+        with self.lock:
+            if name not in self.latencies:
+                self.latencies[name] = []
+                self.counts[name] = 0
+            self.latencies[name].append(seconds)
+            self.counts[name] += count
+
+    def report(self, elapsed_seconds: Union[float, Dict[str, float]]):
+        # Operations run one after the other are timed separately
+        for name in sorted(self.latencies):
+            values = sorted(self.latencies[name])
+            count = self.counts[name]
+            seconds = elapsed_seconds[name] \
+                if isinstance(elapsed_seconds, dict) else elapsed_seconds
+            print(
+                f'{name:>16}: {count} in {seconds:.2f}s '
+                f'({count / seconds:.0f}/s) '
+                f'p50={get_percentile(values, 0.5) * 1000:.3f}ms '
+                f'p99={get_percentile(values, 0.99) * 1000:.3f}ms '
+                f'p999={get_percentile(values, 0.999) * 1000:.3f}ms'
+            )
+
+
+def get_percentile(sorted_values: List[float], percentile: float) -> float:
+    if not sorted_values:
+        return 0
+    position = int(percentile * len(sorted_values))
+    return sorted_values[min(position, len(sorted_values) - 1)]
+
+
+class Client:
+
+    def __init__(self, port: int, encoding: str):
+        self.connection = HTTPConnection('127.0.0.1', port)
+        self.encoding = encoding
+
+    def call(self, method: str, params: dict) -> dict:
+        request_data = {'method': method, 'params': params}
+        if self.encoding == 'json':
+            body = json.dumps(request_data).encode('utf-8')
+        else:
+            body = utils.compress(utils.pack(request_data))
+
+        self.connection.request('POST', '/', body)
+        response = self.connection.getresponse()
+        response_body = response.read()
+        if response.status != 200:
+            raise ValueError(f'unexpected status {response.status}')
+
+        if self.encoding == 'json':
+            response_data = json.loads(response_body)
+        else:
+            response_data = utils.unpack(utils.decompress(response_body))
+
+        # Failed calls are answered with a 200 too
+        if ('status' in response_data
+                and response_data['status'] == STATUS.ERROR):
+            raise ValueError(f"{method} failed: {response_data['error']}")
+        return response_data
+
+
+def get_key(args) -> str:
+    if args.keys == 0:
+        return None
+    return f'key-{random.randrange(args.keys)}'
+
+
+def produce(args, port: int, count: int, recorder: Recorder):
+    client = Client(port, args.encoding)
+    value = 'x' * args.payload_size
+
+    remaining = count
+    while remaining > 0:
+        start = time.perf_counter()
+        if args.batch > 1:
+            batch_size = min(args.batch, remaining)
+            messages = [{
+                'value': value,
+                'key': get_key(args),
+            } for _ in range(batch_size)]
+            client.call(
+                'put_messages',
+                {
+                    'stream': args.stream,
+                    'messages': messages
+                },
+            )
+        else:
+            batch_size = 1
+            client.call(
+                'put_message',
+                {
+                    'stream': args.stream,
+                    'value': value,
+                    'key': get_key(args),
+                },
+            )
+        recorder.record('produce', time.perf_counter() - start, batch_size)
+        remaining -= batch_size
+
+
+def consume(
+    args,
+    port: int,
+    receiver: str,
+    consumed: list,
+    total: int,
+    deadline: float,
+    recorder: Recorder,
+):
+    client = Client(port, args.encoding)
+    params = {
+        'stream': args.stream,
+        'receiver_group': 'bench',
+        'receiver': receiver,
+    }
+
+    while consumed[0] < total and time.time() < deadline:
+        start = time.perf_counter()
+        if args.batch > 1:
+            response = client.call(
+                'get_messages',
+                dict(params, max_messages=args.batch, wait_ms=100),
+            )
+            messages = response['messages'] \
+                if 'messages' in response else []
+        else:
+            response = client.call('get_message', dict(params, wait_ms=100))
+            messages = [response] if response['status'] == STATUS.OK else []
+        recorder.record('consume', time.perf_counter() - start, len(messages))
+
+        if response['status'] == STATUS.ALL_PARTITIONS_ASSIGNED:
+            time.sleep(0.1)
+            continue
+
+        if not messages:
+            continue
+
+        now = utils.get_timestamp_ms()
+        for message in messages:
+            recorder.record('end_to_end', (now - message['timestamp']) / 1000)
+
+        start = time.perf_counter()
+        if args.batch > 1:
+            last_indexes = {}
+            for message in messages:
+                last_indexes[message['partition']] = message['index']
+            client.call(
+                'commit_offsets',
+                dict(
+                    params,
+                    offsets=[{
+                        'partition': partition,
+                        'index': index,
+                    } for partition, index in last_indexes.items()],
+                ),
+            )
+        else:
+            client.call(
+                'commit_message',
+                dict(
+                    params,
+                    partition=messages[0]['partition'],
+                    index=messages[0]['index'],
+                ),
+            )
+        recorder.record('commit', time.perf_counter() - start)
+
+        with recorder.lock:
+            consumed[0] += len(messages)
+
+
+def bench_http(args):
+    data_dir = tempfile.mkdtemp(prefix='stopover-bench-')
+    try:
+        os.makedirs(f'{data_dir}/streams')
+        open(f'{data_dir}/streams/.active', 'w').close()
+
+        config = {
+            'global': {
+                'data_dir': data_dir,
+                'receiver_timeout': 10,
+                'prune_interval': 3600,
+                'partitions': args.partitions,
+                'ttl': 3600,
+                'durability': args.durability,
+                'server': SERVER.THREADED,
+            },
+        }
+
+        # The partitions are created before the clients start
+        broker = Broker(config)
+        broker.describe_stream({'stream': args.stream})
+
+        api = falcon.App()
+        api.add_route('/', broker)
+        server = make_server(
+            '127.0.0.1',
+            0,
+            api,
+            server_class=ThreadingWSGIServer,
+            handler_class=QuietWSGIRequestHandler,
+        )
+        port = server.server_address[1]
+        Thread(target=server.serve_forever, daemon=True).start()
+
+        recorder = Recorder()
+        total = args.messages
+        consumed = [0]
+        deadline = time.time() + args.timeout
+
+        threads = []
+        for producer in range(args.producers):
+            count = total // args.producers
+            if producer < total % args.producers:
+                count += 1
+            threads.append(
+                Thread(target=produce, args=(args, port, count, recorder))
+            )
+        for consumer in range(args.consumers):
+            threads.append(
+                Thread(
+                    target=consume,
+                    args=(
+                        args,
+                        port,
+                        f'consumer-{consumer}',
+                        consumed,
+                        total,
+                        deadline,
+                        recorder,
+                    ),
+                )
+            )
+
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed_seconds = time.time() - start
+
+        server.shutdown()
+        recorder.report(elapsed_seconds)
+        if consumed[0] < total:
+            print(f'only {consumed[0]} of {total} messages were consumed')
+
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def bench_partition(args):
+    data_dir = tempfile.mkdtemp(prefix='stopover-bench-')
+    try:
+        partition = Partition(
+            stream=args.stream,
+            number=0,
+            data_dir=data_dir,
+            create_if_missing=True,
+            durability=args.durability,
+        )
+        recorder = Recorder()
+        value = b'x' * args.payload_size
+        elapsed_seconds = {}
+
+        start = time.perf_counter()
+        remaining = args.messages
+        while remaining > 0:
+            batch_size = min(args.batch, remaining)
+            items = [
+                PartitionItem(value, utils.get_timestamp_ms())
+                for _ in range(batch_size)
+            ]
+            operation_start = time.perf_counter()
+            if batch_size > 1:
+                partition.put_many(items)
+            else:
+                partition.put(items[0])
+            recorder.record(
+                'put',
+                time.perf_counter() - operation_start,
+                batch_size,
+            )
+            remaining -= batch_size
+        elapsed_seconds['put'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            operation_start = time.perf_counter()
+            item = partition.get('bench')
+            partition.commit(item['index'], 'bench')
+            recorder.record(
+                'get_commit',
+                time.perf_counter() - operation_start,
+            )
+        elapsed_seconds['get_commit'] = time.perf_counter() - start
+
+        operation_start = time.perf_counter()
+        partition.prune(0)
+        recorder.record(
+            'prune',
+            time.perf_counter() - operation_start,
+            args.messages,
+        )
+        elapsed_seconds['prune'] = time.perf_counter() - operation_start
+
+        recorder.report(elapsed_seconds)
+        partition.close()
+
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def bench_partitioner(args):
+    partition_numbers = list(range(args.partitions))
+    keys = [f'key-{key}' for key in range(args.keys)]
+
+    for partitioner in (utils.PARTITIONER.LEGACY, utils.PARTITIONER.JUMP):
+        counts = [0] * args.partitions
+        start = time.perf_counter()
+        for key in keys:
+            partition_number = utils.get_partition_number(
+                partition_numbers,
+                key,
+                partitioner,
+            )
+            counts[partition_number] += 1
+        elapsed_seconds = time.perf_counter() - start
+
+        mean = len(keys) / args.partitions
+        deviation = (
+            sum((count - mean)**2 for count in counts) / args.partitions
+        )**0.5
+        print(
+            f'{partitioner:>16}: '
+            f'{elapsed_seconds / len(keys) * 1000000:.2f}us/key '
+            f'min={min(counts)} max={max(counts)} mean={mean:.1f} '
+            f'stddev={deviation / mean * 100:.1f}% '
+            f'empty={counts.count(0)}'
+        )
+
+    # Keys that change partition when a partition is added
+    for partitioner in (utils.PARTITIONER.LEGACY, utils.PARTITIONER.JUMP):
+        moved = 0
+        for key in keys:
+            before = utils.get_partition_number(
+                partition_numbers,
+                key,
+                partitioner,
+            )
+            after = utils.get_partition_number(
+                partition_numbers + [args.partitions],
+                key,
+                partitioner,
+            )
+            if before != after:
+                moved += 1
+        print(
+            f'{partitioner:>16}: {moved / len(keys) * 100:.1f}% of keys '
+            f'move from {args.partitions} to {args.partitions + 1} '
+            'partitions'
+        )
+
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+
+    parser = argparse.ArgumentParser(description='Stopover benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    http_parser = subparsers.add_parser(
+        'http',
+        help='producers and consumers against a broker over HTTP',
+    )
+    http_parser.add_argument('--producers', type=int, default=4)
+    http_parser.add_argument('--consumers', type=int, default=4)
+    http_parser.add_argument('--partitions', type=int, default=4)
+    http_parser.add_argument(
+        '--keys',
+        type=int,
+        default=0,
+        help='distinct keys (0 for random partitions)',
+    )
+    http_parser.add_argument(
+        '--encoding',
+        choices=['msgpack', 'json'],
+        default='msgpack',
+    )
+    http_parser.add_argument('--timeout', type=float, default=300)
+
+    partition_parser = subparsers.add_parser(
+        'partition',
+        help='Partition.put, get and prune without HTTP',
+    )
+
+    partitioner_parser = subparsers.add_parser(
+        'partitioner',
+        help='key distribution and speed of each partitioner',
+    )
+    partitioner_parser.add_argument('--partitions', type=int, default=64)
+    partitioner_parser.add_argument('--keys', type=int, default=100000)
+
+    for subparser in (http_parser, partition_parser):
+        subparser.add_argument('--stream', default='bench')
+        subparser.add_argument('--messages', type=int, default=10000)
+        subparser.add_argument('--payload-size', type=int, default=100)
+        subparser.add_argument(
+            '--batch',
+            type=int,
+            default=1,
+            help='messages per produce and consume call',
+        )
+        subparser.add_argument(
+            '--durability',
+            choices=['strict', 'group', 'relaxed'],
+            default='strict',
+        )
+
+    args = parser.parse_args()
+    if args.benchmark == 'http':
+        bench_http(args)
+    elif args.benchmark == 'partition':
+        bench_partition(args)
+    elif args.benchmark == 'partitioner':
+        bench_partitioner(args)
+
+
+if __name__ == "__main__":
+    main()
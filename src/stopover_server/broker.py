@@ -2,10 +2,37 @@
 # -*- coding: utf-8 -*-
 
 from .version import __version__
-from .partition import Partition, PartitionItem
+from .partition import (
+    Partition,
+    PartitionItem,
+    DURABILITY,
+    STORAGE_FORMAT,
+    DEFAULT_MAX_PRODUCERS,
+)
+from .pool import PartitionPool, DEFAULT_IDLE_TIMEOUT
+from .rebalancer import Rebalancer
+from .streaming import (
+    FORMAT,
+    READ_SIZE,
+    SNAPPY_STREAM_IDENTIFIER,
+    BodyTooLarge,
+    MessageStream,
+    SnappyFramedReader,
+)
+from .storage import (
+    COMPRESSION,
+    LAYOUT,
+    StreamDatabase,
+    get_stream_database_path,
+    import_rocksdb,
+    list_partition_numbers,
+)
 from . import utils
+from . import metrics
 from os import listdir, path
-from threading import Lock, Thread
+from threading import Event, Lock, Thread
+from itertools import islice
+from typing import Generator, List
 import traceback
 import random
 import falcon
@@ -15,6 +42,24 @@ import logging
 import base64
 
 
+DEFAULT_MAX_WAIT_MS = 30000
+
+# Messages written at once from streamed request bodies
+INGEST_BATCH_SIZE = 1000
+
+
+class SERVER:
+    # Single-threaded WSGI server
+    BJOERN = 'bjoern'
+    # One thread per connection
+    THREADED = 'threaded'
+    # falcon.asgi on uvicorn
+    ASGI = 'asgi'
+
+
+DEFAULT_SERVER = SERVER.BJOERN
+
+
 class STATUS:
     OK = 20
     ERROR = 50
@@ -31,8 +76,8 @@ def handle_error(method):
             traceback.print_exc()
             params = args[0]
             return {
-                'stream': params['stream'],
-                'receiver_group': params['receiver_group'],
+                'stream': params.get('stream'),
+                'receiver_group': params.get('receiver_group'),
                 'error': str(error),
                 'status': STATUS.ERROR,
             }
@@ -42,24 +87,76 @@ def handle_error(method):
 
 class Broker:
 
-    def __init__(self, config):
+    def __init__(self, config, cluster=None, background_tasks=True):
         self.config = config
-        utils.log_dict(self.config, prefix='⚙️  ')
+        self.cluster = cluster
+        if background_tasks:
+            utils.log_dict(self.config, prefix='⚙️  ')
 
         self.partitions_by_stream_lock = Lock()
         self.partitions_by_stream = {}
 
-        self.last_seen_by_group_lock = Lock()
-        self.last_seen_by_group = {}
+        # Bytes accepted per request body, unbounded if not set
+        self.max_body_size = self._get_stream_setting(
+            None, 'max_body_size', None
+        )
+
+        # A single-threaded server would stall every client, including the
+        # producers that wake the waiters up, so it never waits
+        self.max_wait_ms = self._get_stream_setting(
+            None, 'max_wait_ms', DEFAULT_MAX_WAIT_MS
+        )
+        server = self._get_stream_setting(None, 'server', DEFAULT_SERVER)
+        if server == SERVER.BJOERN:
+            self.max_wait_ms = 0
 
-        self.partitions_by_group_lock = Lock()
-        self.partitions_by_group = {}
+        self.rebalancer = Rebalancer(
+            self.config['global']['receiver_timeout']
+        )
 
-        self.partitions_lock = Lock()
-        self.partitions = {}
+        # Block cache shared by every partition opened by this process
+        block_cache_size = self._get_stream_setting(
+            None, 'block_cache_size', None
+        )
+        self.block_cache = None
+        if block_cache_size is not None:
+            rocksdb = import_rocksdb('block_cache_size')
+            self.block_cache = rocksdb.LRUCache(block_cache_size)
+
+        # Remote partitions hold no handles
+        max_open_partitions = None if cluster is not None \
+            else self._get_stream_setting(None, 'max_open_partitions', None)
+
+        self.stream_databases_lock = Lock()
+        self.stream_databases = {}
+
+        self.partition_pool = PartitionPool(
+            self._open_partition,
+            max_open_partitions=max_open_partitions,
+            idle_timeout=self._get_stream_setting(
+                None, 'partition_idle_timeout', DEFAULT_IDLE_TIMEOUT
+            ),
+        )
 
-        Thread(target=self._rebalance_loop, daemon=True).start()
-        Thread(target=self._prune_loop, daemon=True).start()
+        self.methods = {
+            'knock': self.knock,
+            'put_message': self.put_message,
+            'put_messages': self.put_messages,
+            'get_message': self.get_message,
+            'get_messages': self.get_messages,
+            'get_partitions': self.get_partitions,
+            'commit_message': self.commit_message,
+            'commit_offsets': self.commit_offsets,
+            'set_offset': self.set_offset,
+            'seek_to_timestamp': self.seek_to_timestamp,
+            'get_lag': self.get_lag,
+            'describe_stream': self.describe_stream,
+        }
+
+        # Worker processes only serve partition calls
+        if background_tasks:
+            Thread(target=self._expire_loop, daemon=True).start()
+            Thread(target=self._prune_loop, daemon=True).start()
 
     def check_authenticated(self, headers):
         if 'authorization' in headers:
@@ -70,6 +167,9 @@ class Broker:
         token = headers['authorization'].split('Basic ')[1]
         client_id, client_secret = base64.b64decode(token) \
             .decode('ascii').split(':')
+        return self.check_credentials(client_id, client_secret)
+
+    def check_credentials(self, client_id, client_secret):
         return (
             client_id in self.config['auth']
             and client_secret == self.config['auth'][client_id]
@@ -86,92 +186,309 @@ class Broker:
             for (key, value) in request.headers.items()
         }
 
+        status = self.authenticate(headers)
+        if status is not None:
+            response.status = status
+            return
+
+        response.status, data = self.handle_body(
+            request.bounded_stream,
+            request.content_length,
+        )
+        self.set_response_data(response, data)
+
+    def handle_body(self, stream, content_length: int = None):
+        if (self.max_body_size is not None and content_length is not None
+                and content_length > self.max_body_size):
+            return falcon.status_codes.HTTP_413, None
+
+        # Snappy framed bodies are decoded and written as they arrive
+        prefix = stream.read(len(SNAPPY_STREAM_IDENTIFIER))
+        if prefix == SNAPPY_STREAM_IDENTIFIER:
+            return self.handle_stream(stream, prefix)
+
+        if self.max_body_size is None:
+            bin_data = prefix + stream.read()
+        else:
+            bin_data = prefix + stream.read(
+                self.max_body_size - len(prefix) + 1
+            )
+            if len(bin_data) > self.max_body_size:
+                return falcon.status_codes.HTTP_413, None
+
+        return self.handle(bin_data)
+
+    def handle_stream(self, stream, prefix: bytes = b''):
+        reader = SnappyFramedReader(stream, prefix, self.max_body_size)
+        unpacker = utils.get_unpacker(reader, READ_SIZE)
+
+        try:
+            response_data = self._ingest(unpacker)
+            if isinstance(response_data, MessageStream):
+                return falcon.status_codes.HTTP_200, response_data
+            response_plain_data = utils.pack(response_data)
+            response_bin_data = utils.compress(response_plain_data)
+
+        except BodyTooLarge:
+            return falcon.status_codes.HTTP_413, None
+
+        except (KeyError, ValueError):
+            return falcon.status_codes.HTTP_400, None
+
+        except Exception:
+            traceback.print_exc()
+            return falcon.status_codes.HTTP_500, None
+
+        metrics.TRANSFERRED_BYTES.inc(
+            len(response_plain_data), direction='out', encoding='plain'
+        )
+        metrics.TRANSFERRED_BYTES.inc(
+            len(response_bin_data), direction='out', encoding='wire'
+        )
+
+        return falcon.status_codes.HTTP_200, response_bin_data
+
+    @staticmethod
+    def set_response_data(response, data):
+        if isinstance(data, MessageStream):
+            response.content_type = data.content_type
+            response.stream = data
+        else:
+            response.data = data
+
+    def authenticate(self, headers: dict):
         if 'auth' in self.config:
             is_authenticated = self.check_authenticated(headers)
             if not is_authenticated:
-                response.status = falcon.status_codes.HTTP_401
-                return
+                return falcon.status_codes.HTTP_401
 
             is_authorized = self.check_authorized(
                 headers
             ) if is_authenticated else False
             if not is_authorized:
-                response.status = falcon.status_codes.HTTP_403
-                return
+                return falcon.status_codes.HTTP_403
 
-        bin_data = request.stream.read()
+    def handle(self, bin_data: bytes):
+        metrics.TRANSFERRED_BYTES.inc(
+            len(bin_data), direction='in', encoding='wire'
+        )
 
         plain_response = False
         if bin_data[:1] == b'{':
             # JSON
             plain_response = True
+            plain_data = bin_data
             data = json.loads(bin_data)
         else:
             # MessagePack
-            data = utils.unpack(utils.decompress(bin_data))
+            plain_data = utils.decompress(bin_data)
+            data = utils.unpack(plain_data)
+
+        metrics.TRANSFERRED_BYTES.inc(
+            len(plain_data), direction='in', encoding='plain'
+        )
 
         if 'method' not in data:
-            response.status = falcon.status_codes.HTTP_400
-            return
-        method = data['method']
-        params = data['params']
+            return falcon.status_codes.HTTP_400, None
 
         try:
-            if method == 'knock':
-                response_data = self.knock(params)
-
-            elif method == 'put_message':
-                response_data = self.put_message(params)
+            # Sent in chunks as the partitions are read
+            if data['method'] == 'stream_messages':
+                response_data = self._handle_stream(
+                    data['params'],
+                    plain_response,
+                )
+                if isinstance(response_data, MessageStream):
+                    return falcon.status_codes.HTTP_200, response_data
+            else:
+                response_data = self.dispatch(data['method'], data['params'])
 
-            elif method == 'get_message':
-                response_data = self.get_message(params)
+            if not plain_response:
+                response_plain_data = utils.pack(response_data)
+                response_bin_data = utils.compress(response_plain_data)
+            else:
+                response_plain_data = \
+                    json.dumps(response_data).encode('utf-8')
+                response_bin_data = response_plain_data
 
-            elif method == 'get_partitions':
-                response_data = self.get_partitions(params)
+        except KeyError:
+            return falcon.status_codes.HTTP_400, None
 
-            elif method == 'commit_message':
-                response_data = self.commit_message(params)
+        except Exception:
+            return falcon.status_codes.HTTP_500, None
 
-            elif method == 'set_offset':
-                response_data = self.set_offset(params)
+        metrics.TRANSFERRED_BYTES.inc(
+            len(response_plain_data), direction='out', encoding='plain'
+        )
+        metrics.TRANSFERRED_BYTES.inc(
+            len(response_bin_data), direction='out', encoding='wire'
+        )
 
+        return falcon.status_codes.HTTP_200, response_bin_data
+
+    def _ingest(self, unpacker):
+        # The request map is walked so that the messages of put_messages
+        # are never held at once, as long as the method comes first
+        method = None
+        params = None
+        for _ in range(unpacker.read_map_header()):
+            key = unpacker.unpack()
+            if key == 'method':
+                method = unpacker.unpack()
+            elif key == 'params' and method == 'put_messages':
+                with metrics.REQUEST_SECONDS.time(method=method):
+                    response_data = self._put_messages_streamed(unpacker)
+                metrics.REQUESTS.inc(
+                    method=method,
+                    status=response_data['status'],
+                )
+                return response_data
+            elif key == 'params':
+                params = unpacker.unpack()
             else:
-                response.status = falcon.status_codes.HTTP_400
-                return
+                unpacker.skip()
+
+        if method is None or params is None:
+            raise ValueError('incomplete request')
+
+        # Sent in chunks as the partitions are read
+        if method == 'stream_messages':
+            return self._handle_stream(params, False)
+        return self.dispatch(method, params)
+
+    def _put_messages_streamed(self, unpacker) -> dict:
+        params = {}
+        response_data = None
+        number_of_params = unpacker.read_map_header()
+        for position in range(number_of_params):
+            name = unpacker.unpack()
+
+            # The stream has to be known before the first write, and the
+            # retries of a producer must be written at once. Messages followed
+            # by other parameters, which may be a producer_id, are held too
+            is_last = position == number_of_params - 1
+            if (name != 'messages' or not is_last or 'stream' not in params
+                    or 'producer_id' in params):
+                params[name] = unpacker.unpack()
+                continue
 
-            if not plain_response:
-                response.data = utils.compress(utils.pack(response_data))
-            else:
-                response.data = json.dumps(response_data).encode('utf-8')
+            response_data = {
+                'stream': params['stream'],
+                'messages': [],
+                'timestamp': utils.get_timestamp_ms(),
+                'status': STATUS.OK,
+            }
 
-        except KeyError:
-            response.status = falcon.status_codes.HTTP_400
-            return
+            messages = []
+            number_of_messages = unpacker.read_array_header()
+            for position in range(number_of_messages):
+                messages.append(unpacker.unpack())
+                if (len(messages) < INGEST_BATCH_SIZE
+                        and position < number_of_messages - 1):
+                    continue
 
-        except Exception:
-            response.status = falcon.status_codes.HTTP_500
-            return
+                batch_response_data = self.put_messages(
+                    dict(params, messages=messages)
+                )
+                if batch_response_data['status'] != STATUS.OK:
+                    return batch_response_data
+
+                if not response_data['messages']:
+                    response_data['timestamp'] = \
+                        batch_response_data['timestamp']
+                response_data['messages'].extend(
+                    batch_response_data['messages']
+                )
+                messages = []
+
+        if response_data is None:
+            return self.put_messages(params)
+        return response_data
+
+    def _handle_stream(self, params: dict, plain_response: bool):
+        stream_format = FORMAT.NDJSON if plain_response else FORMAT.MSGPACK
+        start = time.perf_counter()
+        response_data = self.stream_messages(params, stream_format)
+
+        # Streams are measured once they end, and invalid requests are
+        # answered like those of the other methods
+        if not isinstance(response_data, MessageStream):
+            metrics.REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                method='stream_messages',
+            )
+            metrics.REQUESTS.inc(
+                method='stream_messages',
+                status=response_data['status'],
+            )
+        return response_data
+
+    def dispatch(self, method: str, params: dict) -> dict:
+        # Unknown methods raise a KeyError
+        handler = self.methods[method]
+
+        with metrics.REQUEST_SECONDS.time(method=method):
+            response_data = handler(params)
+
+        status = response_data['status'] if 'status' in response_data \
+            else STATUS.OK
+        metrics.REQUESTS.inc(method=method, status=status)
+
+        return response_data
+
+    def update_metrics(self):
+        # Gauges computed from the in-memory state when scraped
+        lag_samples = []
+        for partition in self.partition_pool.partitions:
+            for receiver_group, lag in partition.get_lags().items():
+                labels = {
+                    'stream': partition.stream,
+                    'partition': partition.number,
+                    'receiver_group': receiver_group,
+                }
+                lag_samples.append((labels, lag))
+        metrics.CONSUMER_LAG.replace(lag_samples)
+
+        metrics.PARTITION_HANDLES.replace([
+            ({'event': event}, value)
+            for event, value in self.partition_pool.stats.items()
+        ])
 
     @handle_error
     def put_message(self, params: dict) -> dict:
         key = None if 'key' not in params else params['key']
         value = params['value']
+        compressed = params['compressed'] if 'compressed' in params \
+            else False
         stream = params['stream']
         partition_number = None if 'partition' not in params \
             else params['partition']
+        producer_id = params['producer_id'] if 'producer_id' in params \
+            else None
+        sequence = params['sequence'] if 'sequence' in params else None
+
+        # Retries of keyless messages must land on the same partition, and
+        # no existing routing depends on these keys
+        partitioner = self._get_partitioner(stream)
+        if key is None and producer_id is not None:
+            key = f'{producer_id}/{sequence}'
+            partitioner = utils.PARTITIONER.JUMP
 
         partition_numbers = self._get_stream_partition_numbers(stream)
         if partition_number is None:
-            partition_number = \
-                utils.get_partition_number(partition_numbers, key)
+            partition_number = utils.get_partition_number(
+                partition_numbers,
+                key,
+                partitioner,
+            )
         elif partition_number not in partition_numbers:
             raise ValueError('partition does not exist')
 
         timestamp = utils.get_timestamp_ms()
-        item = PartitionItem(value, timestamp)
+        item = PartitionItem(value, timestamp, compressed=compressed)
 
         partition = self._get_partition(stream, partition_number)
-        index = partition.put(item)
+        index = partition.put(item, producer_id, sequence)
 
         return {
             'stream': stream,
@@ -181,16 +498,103 @@ class Broker:
             'status': STATUS.OK,
         }
 
+    @handle_error
+    def put_messages(self, params: dict) -> dict:
+        stream = params['stream']
+        messages = params['messages']
+        producer_id = params['producer_id'] if 'producer_id' in params \
+            else None
+        sequence = params['sequence'] if 'sequence' in params else None
+
+        partition_numbers = self._get_stream_partition_numbers(stream)
+        stream_partitioner = self._get_partitioner(stream)
+        timestamp = utils.get_timestamp_ms()
+
+        # Group the messages by partition keeping their original position
+        positions_by_partition = {}
+        items_by_partition = {}
+        for position, message in enumerate(messages):
+            key = None if 'key' not in message else message['key']
+            compressed = message['compressed'] \
+                if 'compressed' in message else False
+            partition_number = None if 'partition' not in message \
+                else message['partition']
+
+            # Retries of keyless messages must land on the same partition,
+            # and no existing routing depends on these keys
+            partitioner = stream_partitioner
+            if key is None and producer_id is not None:
+                key = f'{producer_id}/{sequence}/{position}'
+                partitioner = utils.PARTITIONER.JUMP
+
+            if partition_number is None:
+                partition_number = utils.get_partition_number(
+                    partition_numbers,
+                    key,
+                    partitioner,
+                )
+            elif partition_number not in partition_numbers:
+                raise ValueError('partition does not exist')
+
+            if partition_number not in items_by_partition:
+                positions_by_partition[partition_number] = []
+                items_by_partition[partition_number] = []
+            positions_by_partition[partition_number].append(position)
+            items_by_partition[partition_number].append(
+                PartitionItem(
+                    message['value'],
+                    timestamp,
+                    compressed=compressed,
+                )
+            )
+
+        partitions = [
+            self._get_partition(stream, partition_number)
+            for partition_number in items_by_partition
+        ]
+
+        # Column families of a local database share a single commit
+        if (len(partitions) > 1 and self.cluster is None
+                and self._get_storage_layout(stream) == LAYOUT.STREAM):
+            indexes_by_partition = Partition.put_together(
+                partitions,
+                list(items_by_partition.values()),
+                producer_id,
+                sequence,
+            )
+        else:
+            indexes_by_partition = [
+                partition.put_many(
+                    items_by_partition[partition.number],
+                    producer_id,
+                    sequence,
+                ) for partition in partitions
+            ]
+
+        results = [None] * len(messages)
+        for partition, indexes in zip(partitions, indexes_by_partition):
+            for position, index in zip(
+                positions_by_partition[partition.number],
+                indexes,
+            ):
+                results[position] = {
+                    'partition': partition.number,
+                    'index': index,
+                }
+
+        return {
+            'stream': stream,
+            'messages': results,
+            'timestamp': timestamp,
+            'status': STATUS.OK,
+        }
+
     @handle_error
     def knock(self, params: dict, do_log=True):
         receiver_group = params['receiver_group']
         receiver = params['receiver']
 
-        with self.last_seen_by_group_lock:
-            if receiver_group not in self.last_seen_by_group:
-                self.last_seen_by_group[receiver_group] = {}
-            self.last_seen_by_group[receiver_group][receiver] \
-                = utils.get_timestamp_ms()
+        self.rebalancer.knock(receiver_group, receiver)
 
         if do_log:
             logging.info(f'{receiver_group}/{receiver} is knocking')
@@ -225,42 +629,176 @@ class Broker:
                 'status': STATUS.ALL_PARTITIONS_ASSIGNED,
             }
 
-        done = False
-        while not done:
-            number_of_partitions = len(receiver_partition_numbers)
-            if number_of_partitions == 0:
-                done = True
-                continue
+        def read_message():
+            partition_numbers = list(receiver_partition_numbers)
+            while partition_numbers:
+                number_of_partitions = len(partition_numbers)
+                partition_index = random.randint(0, number_of_partitions - 1)
+                partition_number = partition_numbers.pop(partition_index)
+
+                partition = self._get_partition(stream, partition_number)
+                item = partition.get(receiver_group, index)
+
+                if item is None:
+                    continue
+
+                response_data = {
+                    'stream': stream,
+                    'receiver_group': receiver_group,
+                    'receiver': receiver,
+                    'partition': partition_number,
+                    'index': item['index'],
+                    'value': item['value'],
+                    'timestamp': item['timestamp'],
+                    'assigned_partitions': partition_numbers,
+                    'status': STATUS.OK
+                }
+                if 'compressed' in item:
+                    response_data['compressed'] = item['compressed']
+                return response_data
+
+        # Explicit indexes are never waited for
+        wait_seconds = 0 if index is not None \
+            else self._get_wait_seconds(params)
+
+        response_data = self._poll(
+            stream,
+            receiver_partition_numbers,
+            wait_seconds,
+            read_message,
+        )
+        if response_data is not None:
+            return response_data
 
-            partition_index = random.randint(0, number_of_partitions - 1)
-            partition_number = receiver_partition_numbers.pop(partition_index)
+        return {
+            'stream': stream,
+            'receiver_group': receiver_group,
+            'receiver': receiver,
+            'assigned_partitions': [],
+            'status': STATUS.END_OF_STREAM,
+        }
 
-            partition = self._get_partition(stream, partition_number)
-            item = partition.get(receiver_group, index)
+    @handle_error
+    def get_messages(self, params: dict) -> dict:
+        stream = params['stream']
+        receiver_group = params['receiver_group']
+        receiver = params['receiver']
+        max_messages = params['max_messages']
+        max_bytes = params['max_bytes'] if 'max_bytes' in params else None
 
-            if item is None:
-                continue
+        self.knock(params, do_log=False)
 
+        receiver_partition_numbers = self._get_receiver_partition_numbers(
+            stream,
+            receiver_group,
+            receiver,
+        )
+
+        if len(receiver_partition_numbers) == 0:
             return {
                 'stream': stream,
                 'receiver_group': receiver_group,
                 'receiver': receiver,
-                'partition': partition_number,
-                'index': item['index'],
-                'value': item['value'],
-                'timestamp': item['timestamp'],
                 'assigned_partitions': receiver_partition_numbers,
-                'status': STATUS.OK
+                'status': STATUS.ALL_PARTITIONS_ASSIGNED,
             }
 
+        def read_messages():
+            partition_numbers = list(receiver_partition_numbers)
+            random.shuffle(partition_numbers)
+
+            messages = []
+            total_bytes = 0
+            for partition_number in partition_numbers:
+                remaining_messages = max_messages - len(messages)
+                if remaining_messages <= 0:
+                    break
+
+                remaining_bytes = None
+                if max_bytes is not None:
+                    remaining_bytes = max_bytes - total_bytes
+                    if messages and remaining_bytes <= 0:
+                        break
+
+                partition = self._get_partition(stream, partition_number)
+                items = partition.get_many(
+                    receiver_group,
+                    remaining_messages,
+                    remaining_bytes,
+                )
+
+                for item in items:
+                    total_bytes += item['size']
+                    messages.append(self._get_message(partition_number, item))
+
+            return messages or None
+
+        messages = self._poll(
+            stream,
+            receiver_partition_numbers,
+            self._get_wait_seconds(params),
+            read_messages,
+        )
+        if messages is None:
+            messages = []
+
         return {
             'stream': stream,
             'receiver_group': receiver_group,
             'receiver': receiver,
+            'messages': messages,
             'assigned_partitions': receiver_partition_numbers,
-            'status': STATUS.END_OF_STREAM,
+            'status': STATUS.OK if messages else STATUS.END_OF_STREAM,
         }
 
+    @handle_error
+    def stream_messages(self, params: dict, stream_format: str):
+        start = time.perf_counter()
+        stream = params['stream']
+        receiver_group = params['receiver_group']
+        receiver = params['receiver']
+        partition_number = params['partition'] if 'partition' in params \
+            else None
+        index = params['index'] if 'index' in params else None
+        max_messages = params['max_messages'] \
+            if 'max_messages' in params else None
+        if 'format' in params:
+            stream_format = params['format']
+
+        self.knock(params, do_log=False)
+
+        # Replays of a given partition, or the assigned partitions from the
+        # offsets of the receiver group
+        if partition_number is not None:
+            if partition_number not in \
+                    self._get_stream_partition_numbers(stream):
+                raise ValueError('partition does not exist')
+            partition_numbers = [partition_number]
+        else:
+            if index is not None:
+                raise ValueError('an index requires a partition')
+            partition_numbers = self._get_receiver_partition_numbers(
+                stream,
+                receiver_group,
+                receiver,
+            )
+
+        return MessageStream(
+            self._measure_stream(
+                self._iter_messages(
+                    stream,
+                    receiver_group,
+                    partition_numbers,
+                    index,
+                    max_messages,
+                ),
+                start,
+            ),
+            stream_format,
+            end_status=STATUS.END_OF_STREAM,
+            error_status=STATUS.ERROR,
+        )
+
     @handle_error
     def get_partitions(self, params: dict) -> dict:
         stream = params['stream']
@@ -288,9 +826,43 @@ class Broker:
         partition_number = params['partition']
         index = params['index']
         receiver_group = params['receiver_group']
+        cumulative = params['cumulative'] if 'cumulative' in params \
+            else False
 
         partition = self._get_partition(stream, partition_number)
-        partition.commit(index, receiver_group)
+        partition.commit(index, receiver_group, cumulative)
+
+        return {
+            'stream': stream,
+            'receiver_group': receiver_group,
+            'status': STATUS.OK,
+        }
+
+    @handle_error
+    def commit_offsets(self, params: dict) -> dict:
+        stream = params['stream']
+        receiver_group = params['receiver_group']
+        offsets = params['offsets']
+
+        # Every offset is checked before committing any of them, so that a
+        # batch is never applied partially
+        partition_numbers = self._get_stream_partition_numbers(stream)
+        partitions = []
+        for offset in offsets:
+            if offset['partition'] not in partition_numbers:
+                raise ValueError('partition does not exist')
+
+            partition = self._get_partition(stream, offset['partition'])
+            head_index = partition.describe()['head_index']
+            if offset['index'] > head_index:
+                raise ValueError(
+                    f"trying to commit offset {offset['index']} beyond the "
+                    f"head {head_index} of partition {offset['partition']}"
+                )
+            partitions.append(partition)
+
+        for partition, offset in zip(partitions, offsets):
+            partition.commit(offset['index'], receiver_group, cumulative=True)
 
         return {
             'stream': stream,
@@ -316,18 +888,361 @@ class Broker:
             'status': STATUS.OK,
         }
 
-    def _get_partition(self, stream: str, partition_number: int):
-        with self.partitions_lock:
-            if stream not in self.partitions:
-                self.partitions[stream] = {}
+    @handle_error
+    def seek_to_timestamp(self, params: dict) -> dict:
+        stream = params['stream']
+        receiver_group = params['receiver_group']
+        timestamp = params['timestamp']
+
+        stream_partition_numbers = self._get_stream_partition_numbers(stream)
+        if 'partition' in params:
+            if params['partition'] not in stream_partition_numbers:
+                raise ValueError('partition does not exist')
+            partition_numbers = [params['partition']]
+        else:
+            partition_numbers = stream_partition_numbers
+
+        partitions = []
+        for partition_number in partition_numbers:
+            with self._borrow_partition(stream, partition_number) as partition:
+                index = partition.seek(receiver_group, timestamp)
+            partitions.append({'partition': partition_number, 'index': index})
+
+        return {
+            'stream': stream,
+            'receiver_group': receiver_group,
+            'timestamp': timestamp,
+            'partitions': partitions,
+            'status': STATUS.OK,
+        }
+
+    @handle_error
+    def get_lag(self, params: dict) -> dict:
+        stream = params['stream']
+        receiver_group = params['receiver_group']
+
+        partitions = []
+        total_lag = 0
+        for partition_number in self._get_stream_partition_numbers(stream):
+            with self._borrow_partition(stream, partition_number) as partition:
+                description = partition.describe()
+
+            receiver_groups = description['receiver_groups']
+            if receiver_group in receiver_groups:
+                offset = receiver_groups[receiver_group]['offset']
+                lag = receiver_groups[receiver_group]['lag']
+            else:
+                offset = -1
+                lag = description['messages']
 
-            if partition_number not in self.partitions[stream]:
-                self.partitions[stream][partition_number] = Partition(
-                    stream=stream,
-                    number=partition_number,
-                    data_dir=self.config['global']['data_dir']
+            total_lag += lag
+            partitions.append({
+                'partition': partition_number,
+                'head_index': description['head_index'],
+                'offset': offset,
+                'lag': lag,
+            })
+
+        return {
+            'stream': stream,
+            'receiver_group': receiver_group,
+            'lag': total_lag,
+            'partitions': partitions,
+            'status': STATUS.OK,
+        }
+
+    @handle_error
+    def describe_stream(self, params: dict) -> dict:
+        stream = params['stream']
+
+        partitions = []
+        for partition_number in self._get_stream_partition_numbers(stream):
+            with self._borrow_partition(stream, partition_number) as partition:
+                description = partition.describe()
+            description['partition'] = partition_number
+            partitions.append(description)
+
+        return {
+            'stream': stream,
+            'partitions': partitions,
+            'status': STATUS.OK,
+        }
+
+    def _iter_messages(
+        self,
+        stream: str,
+        receiver_group: str,
+        partition_numbers: List[int],
+        index: int = None,
+        max_messages: int = None,
+    ) -> Generator:
+        remaining_messages = max_messages
+        for partition_number in partition_numbers:
+            partition = self._get_partition(stream, partition_number)
+            start_index = index if index is not None \
+                else partition.get_offset(receiver_group) + 1
+
+            items = partition.iter_messages(start_index)
+            if remaining_messages is not None:
+                items = islice(items, remaining_messages)
+
+            for item in items:
+                if remaining_messages is not None:
+                    remaining_messages -= 1
+                yield self._get_message(partition_number, item)
+
+            if remaining_messages is not None and remaining_messages <= 0:
+                return
+
+    @staticmethod
+    def _measure_stream(messages: Generator, start: float) -> Generator:
+        # Streams that fail or are closed before their end count as errors
+        status = STATUS.ERROR
+        try:
+            yield from messages
+            status = STATUS.OK
+        finally:
+            metrics.REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                method='stream_messages',
+            )
+            metrics.REQUESTS.inc(method='stream_messages', status=status)
+
+    @staticmethod
+    def _get_message(partition_number: int, item: dict) -> dict:
+        message = {
+            'partition': partition_number,
+            'index': item['index'],
+            'value': item['value'],
+            'timestamp': item['timestamp'],
+        }
+        if 'compressed' in item:
+            message['compressed'] = item['compressed']
+        return message
+
+    def _get_wait_seconds(self, params: dict) -> float:
+        wait_ms = params['wait_ms'] if 'wait_ms' in params else 0
+        return max(0, min(wait_ms, self.max_wait_ms)) / 1000
+
+    def _poll(
+        self,
+        stream: str,
+        partition_numbers: list,
+        wait_seconds: float,
+        read,
+    ):
+        # Calls `read` until it returns something or the wait expires,
+        # waking up whenever a message is appended to one of the partitions
+        if not wait_seconds:
+            return read()
+
+        deadline = time.time() + wait_seconds
+        wakeup = Event()
+
+        partitions = [
+            self._get_partition(stream, partition_number)
+            for partition_number in partition_numbers
+        ]
+        for partition in partitions:
+            partition.add_waiter(wakeup)
+
+        try:
+            while True:
+                # Cleared before reading so that no append is missed
+                wakeup.clear()
+                result = read()
+                if result is not None:
+                    return result
+
+                remaining_seconds = deadline - time.time()
+                if remaining_seconds <= 0:
+                    return None
+                if not wakeup.wait(remaining_seconds):
+                    return None
+        finally:
+            for partition in partitions:
+                partition.remove_waiter(wakeup)
+
+    def _get_partition(
+        self,
+        stream: str,
+        partition_number: int,
+        create_if_missing: bool = False,
+    ):
+        return self.partition_pool.get(
+            stream,
+            partition_number,
+            create_if_missing,
+        )
+
+    def _borrow_partition(
+        self,
+        stream: str,
+        partition_number: int,
+        create_if_missing: bool = False,
+    ):
+        # For passes over whole streams, which do not keep open the
+        # partitions that nobody else is using
+        return self.partition_pool.borrow(
+            stream,
+            partition_number,
+            create_if_missing,
+        )
+
+    def _open_partition(
+        self,
+        stream: str,
+        partition_number: int,
+        create_if_missing: bool,
+    ):
+        layout = self._get_storage_layout(stream)
+
+        # Partitions owned by another worker process
+        if self.cluster is not None:
+            return self.cluster.get_partition(
+                stream,
+                partition_number,
+                create_if_missing,
+                by_stream=layout == LAYOUT.STREAM,
+            )
+
+        store = None
+        if layout == LAYOUT.STREAM:
+            store = self._get_stream_database(stream).get_store(
+                partition_number,
+                create_if_missing,
+            )
+
+        return Partition(
+            stream=stream,
+            number=partition_number,
+            data_dir=self.config['global']['data_dir'],
+            create_if_missing=create_if_missing,
+            store=store,
+            **self._get_partition_options(stream),
+        )
+
+    def _get_storage_layout(self, stream: str) -> str:
+        layout = self._get_stream_setting(
+            stream, 'storage_layout', LAYOUT.PARTITION
+        )
+        if layout not in (LAYOUT.PARTITION, LAYOUT.STREAM):
+            raise ValueError(f'unknown storage layout "{layout}"')
+        return layout
+
+    def _get_stream_database(self, stream: str) -> StreamDatabase:
+        with self.stream_databases_lock:
+            if stream not in self.stream_databases:
+                self.stream_databases[stream] = StreamDatabase(
+                    get_stream_database_path(
+                        self.config['global']['data_dir'],
+                        stream,
+                    ),
+                    Partition.get_store_options(
+                        create_if_missing=True,
+                        store_options=self._get_store_options(stream),
+                    ),
                 )
-        return self.partitions[stream][partition_number]
+            return self.stream_databases[stream]
+
+    def _get_stream_setting(self, stream: str, name: str, default=None):
+        try:
+            return self.config['streams'][stream][name]
+        except (KeyError, TypeError):
+            pass
+
+        try:
+            return self.config['global'][name]
+        except KeyError:
+            return default
+
+    def _get_partitioner(self, stream: str) -> str:
+        return self._get_stream_setting(
+            stream, 'partitioner', utils.PARTITIONER.LEGACY
+        )
+
+    def _get_partition_options(self, stream: str) -> dict:
+        return {
+            'durability': self._get_stream_setting(
+                stream, 'durability', DURABILITY.STRICT
+            ),
+            'group_commit_ms': self._get_stream_setting(
+                stream, 'group_commit_ms', 2
+            ),
+            'group_commit_messages': self._get_stream_setting(
+                stream, 'group_commit_messages', 256
+            ),
+            'store_options': self._get_store_options(stream),
+            'storage_format': self._get_stream_setting(
+                stream, 'storage_format', STORAGE_FORMAT.BINARY
+            ),
+            'max_producers': self._get_stream_setting(
+                stream, 'max_producers', DEFAULT_MAX_PRODUCERS
+            ),
+        }
+
+    def _get_store_options(self, stream: str) -> dict:
+        store_options = {}
+
+        table_factory = self._get_table_factory(stream)
+        if table_factory is not None:
+            store_options['table_factory'] = table_factory
+
+        compression = self._get_stream_setting(stream, 'compression', None)
+        if compression is not None:
+            if compression not in COMPRESSION:
+                raise ValueError(f'unknown compression "{compression}"')
+            store_options['compression'] = COMPRESSION[compression]
+
+        # Dictionaries trained on samples of every SST file, which pay off
+        # with many small and similar messages
+        dict_bytes = self._get_stream_setting(
+            stream, 'compression_dict_bytes', None
+        )
+        if dict_bytes:
+            store_options['compression_opts'] = {
+                'max_dict_bytes': dict_bytes,
+                'zstd_max_train_bytes': dict_bytes * 100,
+            }
+
+        for name in (
+            'write_buffer_size',
+            'max_write_buffer_number',
+            'max_open_files',
+            'compaction_style',
+        ):
+            value = self._get_stream_setting(stream, name, None)
+            if value is not None:
+                store_options[name] = value
+
+        return store_options
+
+    def _get_table_factory(self, stream: str):
+        block_size = self._get_stream_setting(stream, 'block_size', None)
+        bloom_filter_bits = self._get_stream_setting(
+            stream, 'bloom_filter_bits', None
+        )
+
+        # The default table options need no bindings
+        if (self.block_cache is None and block_size is None
+                and bloom_filter_bits is None):
+            return None
+
+        rocksdb = import_rocksdb('block_size or bloom_filter_bits')
+        table_options = {}
+
+        # Shared across partitions to bound the memory of the process
+        if self.block_cache is not None:
+            table_options['block_cache'] = self.block_cache
+
+        if block_size is not None:
+            table_options['block_size'] = block_size
+
+        if bloom_filter_bits is not None:
+            table_options['filter_policy'] = \
+                rocksdb.BloomFilterPolicy(bloom_filter_bits)
+
+        return rocksdb.BlockBasedTableFactory(**table_options)
 
     def _get_receiver_partition_numbers(
         self,
@@ -335,20 +1250,15 @@ class Broker:
         receiver_group,
         receiver,
     ):
-        with self.partitions_by_group_lock:
-            if stream not in self.partitions_by_group:
-                self.partitions_by_group[stream] = {}
-
-            if receiver_group not in self.partitions_by_group[stream]:
-                self.partitions_by_group[stream][receiver_group] = {}
-
-            if receiver not in self.partitions_by_group[stream][receiver_group
-                                                                ]:
-                self.partitions_by_group[stream][receiver_group][receiver] = []
+        # Opens the missing partitions before taking the rebalancer lock
+        partition_numbers = self._get_stream_partition_numbers(stream)
 
-            return list(
-                self.partitions_by_group[stream][receiver_group][receiver]
-            )
+        return self.rebalancer.get_partitions(
+            stream,
+            receiver_group,
+            receiver,
+            partition_numbers,
+        )
 
     def _get_stream_path(self, stream: str) -> str:
         return f"{self.config['global']['data_dir']}/streams/{stream}/"
@@ -367,13 +1277,7 @@ class Broker:
             except KeyError:
                 partitions_target = self.config['global']['partitions']
 
-            stream_path = self._get_stream_path(stream)
-            if path.isdir(stream_path):
-                for partition_number in sorted(listdir(stream_path)):
-                    try:
-                        partition_numbers.append(int(partition_number))
-                    except ValueError:
-                        continue
+            partition_numbers.extend(self._list_partition_numbers(stream))
 
             existing_partitions = len(partition_numbers)
             if partitions_target > existing_partitions:
@@ -384,108 +1288,38 @@ class Broker:
                             f'missing partitions among {partition_numbers}'
                         )
 
-                    Partition(
-                        stream=stream,
-                        number=partition_number,
-                        data_dir=self.config['global']['data_dir'],
-                        create_if_missing=True
-                    )
-                    partition_numbers.append(partition_number)
+                    with self._borrow_partition(
+                            stream,
+                            partition_number,
+                            create_if_missing=True,
+                    ):
+                        partition_numbers.append(partition_number)
 
             return self.partitions_by_stream[stream]
 
-    def _rebalance_loop(self):
-        while True:
-            self._rebalance()
-            remaining_seconds = self.config['global']['rebalance_interval']
-            logging.debug(
-                f"next rebalance will hapen in {remaining_seconds} seconds"
-            )
-            time.sleep(self.config['global']['rebalance_interval'])
-
-    def _rebalance(self):
-        with self.partitions_by_group_lock:
-            logging.debug('rebalancing...')
-            if self.partitions_by_group:
-                utils.log_dict(self.partitions_by_group)
-
-            receivers_to_remove = []
-            for stream in self.partitions_by_group:
-
-                for receiver_group in self.partitions_by_group[stream].keys():
-                    stream_receiver_group_receivers = []
-
-                    for receiver in self.partitions_by_group[stream][
-                            receiver_group].keys():
-                        receiver_unseen_time = (
-                            utils.get_timestamp_ms()
-                            - self.last_seen_by_group[receiver_group][receiver]
-                        ) / 1000
-
-                        if receiver_unseen_time < self.config['global'][
-                                'receiver_timeout']:
-                            stream_receiver_group_receivers.append(receiver)
-
-                        else:
-                            receivers_to_remove.append(
-                                (stream, receiver_group, receiver)
-                            )
-
-                    stream_partition_numbers = \
-                        self._get_stream_partition_numbers(stream)
-
-                    number_of_partitions = len(stream_partition_numbers)
-                    number_of_receivers = len(stream_receiver_group_receivers)
-
-                    if number_of_receivers > number_of_partitions:
-                        number_of_partitions = number_of_receivers
-
-                    if not number_of_receivers:
-                        continue
-
-                    step = number_of_partitions // number_of_receivers
-                    remainder = number_of_partitions % number_of_receivers
-
-                    for index in range(0, number_of_partitions - remainder,
-                                       step):
-                        receiver_index = index // step
-                        self.partitions_by_group[stream][receiver_group][
-                            stream_receiver_group_receivers[receiver_index]
-                        ] = stream_partition_numbers[index:index + step]
-
-                    for index in range(number_of_partitions - remainder,
-                                       number_of_partitions):
-                        receiver_index = index - number_of_partitions + 1
-                        self.partitions_by_group[stream][receiver_group][
-                            stream_receiver_group_receivers[receiver_index]
-                        ].append(stream_partition_numbers[index])
-
-            for stream, receiver_group, receiver in receivers_to_remove:
-                logging.info(
-                    f'receiver "{receiver}" kicked from the '
-                    f'receiver_group "{receiver_group}" '
-                    f'for the stream "{stream}"'
+    def _list_partition_numbers(self, stream: str):
+        if self._get_storage_layout(stream) == LAYOUT.STREAM:
+            return list_partition_numbers(
+                get_stream_database_path(
+                    self.config['global']['data_dir'],
+                    stream,
                 )
-                del self.partitions_by_group[stream][receiver_group][receiver]
-                if receiver in self.last_seen_by_group[receiver_group]:
-                    del self.last_seen_by_group[receiver_group][receiver]
-
-            # Remove empty groups
-            groups_to_remove = []
-            for stream in self.partitions_by_group:
-                for receiver_group in self.partitions_by_group[stream].keys():
-                    if not self.partitions_by_group[stream][receiver_group]:
-                        groups_to_remove.append((stream, receiver_group))
-            for stream, receiver_group in groups_to_remove:
-                del self.partitions_by_group[stream][receiver_group]
-
-            # Remove streams without assignments
-            streams_to_remove = []
-            for stream in self.partitions_by_group:
-                if not self.partitions_by_group[stream]:
-                    streams_to_remove.append(stream)
-            for stream in streams_to_remove:
-                del self.partitions_by_group[stream]
+            )
+
+        partition_numbers = []
+        stream_path = self._get_stream_path(stream)
+        if path.isdir(stream_path):
+            for partition_number in sorted(listdir(stream_path)):
+                try:
+                    partition_numbers.append(int(partition_number))
+                except ValueError:
+                    continue
+        return partition_numbers
+
+    def _expire_loop(self):
+        # Sleeps until the next receiver may time out
+        while True:
+            time.sleep(self.rebalancer.expire())
 
     def _prune_loop(self):
         while True:
@@ -494,12 +1328,7 @@ class Broker:
             for stream in listdir(streams_path):
                 stream_path = self._get_stream_path(stream)
                 if path.isdir(stream_path):
-                    partition_numbers = []
-                    for partition_number in sorted(listdir(stream_path)):
-                        try:
-                            partition_numbers.append(int(partition_number))
-                        except ValueError:
-                            continue
+                    partition_numbers = self._list_partition_numbers(stream)
 
                     stream_with_defined_ttl = \
                         'streams' in self.config \
@@ -511,12 +1340,26 @@ class Broker:
                     else:
                         ttl = self.config['global']['ttl']
 
+                    compact = self._get_stream_setting(
+                        stream, 'prune_compaction', False
+                    )
+
                     for partition_number in partition_numbers:
                         logging.info(
                             f'pruning stream {stream} (partition {partition_number})'
                         )
 
-                        partition = self._get_partition(
-                            stream, partition_number
-                        )
-                        partition.prune(int(ttl))
+                        # A failing partition does not stop the others
+                        try:
+                            with self._borrow_partition(
+                                    stream,
+                                    partition_number,
+                            ) as partition:
+                                partition.prune(int(ttl), compact)
+                        except Exception:
+                            traceback.print_exc()
+
+            utils.log_dict(
+                self.partition_pool.stats,
+                key_prefix='partition_pool.',
+            )
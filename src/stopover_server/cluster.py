@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from .broker import Broker
+from .partition import PartitionItem
+from multiprocessing import Process
+from multiprocessing.connection import Client, Listener
+from threading import Event, Lock, Thread, local
+from typing import Generator, List
+import traceback
+import tempfile
+import logging
+import time
+import zlib
+import os
+
+CONNECT_TIMEOUT = 30  # seconds
+
+# Messages per call when iterating over a remote partition
+ITER_BATCH_SIZE = 1000
+
+# Partition methods that can be called from the front process
+OPERATIONS = set([
+    'put',
+    'put_many',
+    'get',
+    'get_many',
+    'get_range',
+    'get_offset',
+    'commit',
+    'set_offset',
+    'prune',
+    'seek',
+    'get_lags',
+    'describe',
+])
+
+
+def get_owner(
+    stream: str,
+    partition_number: int,
+    processes: int,
+    by_stream: bool = False,
+) -> int:
+    # Streams stored in a single database must be owned by a single worker
+    if by_stream:
+        key = stream.encode('utf-8')
+    else:
+        key = f'{stream}/{partition_number}'.encode('utf-8')
+    return zlib.crc32(key) % processes
+
+
+def _copy_value(item: dict):
+    if isinstance(item['value'], memoryview):
+        item['value'] = item['value'].tobytes()
+
+
+class PartitionWorker:
+
+    def __init__(self, config, address: str, authkey: bytes):
+        self.broker = Broker(config, background_tasks=False)
+        self.listener = Listener(address, family='AF_UNIX', authkey=authkey)
+
+    def serve_forever(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except Exception:
+                traceback.print_exc()
+                continue
+
+            Thread(
+                target=self._serve_connection,
+                args=(connection, ),
+                daemon=True,
+            ).start()
+
+    def _serve_connection(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except EOFError:
+                    return
+
+                try:
+                    result = self._call(*request)
+                except Exception as error:
+                    connection.send(('error', error))
+                else:
+                    connection.send(('ok', result))
+
+    def _call(
+        self,
+        stream: str,
+        partition_number: int,
+        create_if_missing: bool,
+        operation: str,
+        args: tuple,
+        kwargs: dict,
+    ):
+        partition = self.broker._get_partition(
+            stream,
+            partition_number,
+            create_if_missing,
+        )
+
+        # Opening the partition is enough
+        if operation is None:
+            return None
+
+        if operation not in OPERATIONS:
+            raise ValueError(f'unknown operation "{operation}"')
+        result = getattr(partition, operation)(*args, **kwargs)
+
+        # Values sliced from the stored records cannot be pickled
+        if operation == 'get' and result is not None:
+            _copy_value(result)
+        elif operation in ('get_many', 'get_range'):
+            for item in result:
+                _copy_value(item)
+
+        return result
+
+
+class WorkerClient:
+
+    def __init__(self, address: str, authkey: bytes):
+        self.address = address
+        self.authkey = authkey
+
+        # One connection per thread, so that calls never interleave
+        self._local = local()
+
+    def call(self, *request):
+        connection = self._get_connection()
+        connection.send(request)
+        status, result = connection.recv()
+        if status == 'error':
+            raise result
+        return result
+
+    def _get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            return connection
+
+        deadline = time.time() + CONNECT_TIMEOUT
+        while True:
+            try:
+                connection = Client(
+                    self.address,
+                    family='AF_UNIX',
+                    authkey=self.authkey,
+                )
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                # The worker may still be starting
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+        self._local.connection = connection
+        return connection
+
+
+class RemotePartition:
+
+    def __init__(
+        self,
+        stream: str,
+        number: int,
+        client: WorkerClient,
+        create_if_missing: bool = False,
+    ):
+        self.stream = stream
+        self.number = number
+        self._client = client
+
+        # Every put goes through the front process, so waiters are woken up
+        # here instead of in the owner worker
+        self._waiters_lock = Lock()
+        self._waiters = set()
+
+        self._client.call(stream, number, create_if_missing, None, (), {})
+
+    def put(self, item: PartitionItem, *args, **kwargs) -> int:
+        index = self._call('put', item, *args, **kwargs)
+        self._notify_waiters()
+        return index
+
+    def put_many(
+        self,
+        items: List[PartitionItem],
+        *args,
+        **kwargs,
+    ) -> List[int]:
+        indexes = self._call('put_many', items, *args, **kwargs)
+        self._notify_waiters()
+        return indexes
+
+    def get(self, *args, **kwargs) -> dict:
+        return self._call('get', *args, **kwargs)
+
+    def get_many(self, *args, **kwargs) -> List[dict]:
+        return self._call('get_many', *args, **kwargs)
+
+    def get_range(self, *args, **kwargs) -> List[dict]:
+        return self._call('get_range', *args, **kwargs)
+
+    def iter_messages(self, start_index: int) -> Generator:
+        # Generators cannot cross processes, so the messages up to the
+        # current head are fetched in batches
+        head_index = self.describe()['head_index']
+        while start_index <= head_index:
+            items = self.get_range(start_index, ITER_BATCH_SIZE)
+            for item in items:
+                if item['index'] > head_index:
+                    return
+                yield item
+
+            if len(items) < ITER_BATCH_SIZE:
+                return
+            start_index = items[-1]['index'] + 1
+
+    def get_offset(self, *args, **kwargs) -> int:
+        return self._call('get_offset', *args, **kwargs)
+
+    def commit(self, *args, **kwargs):
+        return self._call('commit', *args, **kwargs)
+
+    def set_offset(self, *args, **kwargs):
+        return self._call('set_offset', *args, **kwargs)
+
+    def prune(self, *args, **kwargs):
+        return self._call('prune', *args, **kwargs)
+
+    def seek(self, *args, **kwargs) -> int:
+        return self._call('seek', *args, **kwargs)
+
+    def get_lags(self) -> dict:
+        return self._call('get_lags')
+
+    def describe(self) -> dict:
+        return self._call('describe')
+
+    @property
+    def is_idle(self) -> bool:
+        return False
+
+    def close(self):
+        pass
+
+    def add_waiter(self, event: Event):
+        with self._waiters_lock:
+            self._waiters.add(event)
+
+    def remove_waiter(self, event: Event):
+        with self._waiters_lock:
+            self._waiters.discard(event)
+
+    def _notify_waiters(self):
+        with self._waiters_lock:
+            for event in self._waiters:
+                event.set()
+
+    def _call(self, operation: str, *args, **kwargs):
+        return self._client.call(
+            self.stream,
+            self.number,
+            False,
+            operation,
+            args,
+            kwargs,
+        )
+
+
+class Cluster:
+
+    def __init__(self, clients: List[WorkerClient]):
+        self.clients = clients
+
+    @property
+    def processes(self) -> int:
+        return len(self.clients)
+
+    def get_partition(
+        self,
+        stream: str,
+        partition_number: int,
+        create_if_missing: bool = False,
+        by_stream: bool = False,
+    ) -> RemotePartition:
+        owner = get_owner(
+            stream,
+            partition_number,
+            self.processes,
+            by_stream,
+        )
+        return RemotePartition(
+            stream,
+            partition_number,
+            self.clients[owner],
+            create_if_missing,
+        )
+
+    @staticmethod
+    def start(config, processes: int) -> 'Cluster':
+        # Must be called before any thread is started in this process
+        sockets_dir = tempfile.mkdtemp(prefix='stopover-')
+        authkey = os.urandom(32)
+
+        clients = []
+        for worker_number in range(processes):
+            address = f'{sockets_dir}/worker-{worker_number}.sock'
+            Process(
+                target=run_worker,
+                args=(config, address, authkey),
+                name=f'stopover-worker-{worker_number}',
+                daemon=True,
+            ).start()
+            clients.append(WorkerClient(address, authkey))
+
+        logging.info(f'started {processes} worker processes')
+        return Cluster(clients)
+
+
+def run_worker(config, address: str, authkey: bytes):
+    PartitionWorker(config, address, authkey).serve_forever()
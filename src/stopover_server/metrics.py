@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, List, Tuple
+import time
+
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+def _format_labels(label_names: Tuple, label_values: Tuple, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+
+    labels = ','.join(
+        f'{name}="{_escape(str(value))}"' for name, value in pairs
+    )
+    return f'{{{labels}}}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name: str, description: str, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.lock = Lock()
+
+    def _get_label_values(self, labels: Dict) -> Tuple:
+        return tuple(labels[name] for name in self.label_names)
+
+    def render(self) -> List[str]:
+        lines = [
+            f'# HELP {self.name} {self.description}',
+            f'# TYPE {self.name} {self.TYPE}',
+        ]
+        lines.extend(self._render_samples())
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name: str, description: str, label_names=()):
+        super().__init__(name, description, label_names)
+        self._values = {}
+
+    def inc(self, value: float = 1, **labels):
+        label_values = self._get_label_values(labels)
+        with self.lock:
+            if label_values not in self._values:
+                self._values[label_values] = 0
+            self._values[label_values] += value
+
+    def _render_samples(self) -> List[str]:
+        with self.lock:
+            values = dict(self._values)
+
+        return [
+            f'{self.name}'
+            f'{_format_labels(self.label_names, label_values)} '
+            f'{_format_value(value)}'
+            for label_values, value in values.items()
+        ]
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, description: str, label_names=()):
+        super().__init__(name, description, label_names)
+        self._values = {}
+
+    def set(self, value: float, **labels):
+        label_values = self._get_label_values(labels)
+        with self.lock:
+            self._values[label_values] = value
+
+    def replace(self, samples: List[Tuple[Dict, float]]):
+        # Drops the samples that are no longer reported
+        values = {
+            self._get_label_values(labels): value
+            for labels, value in samples
+        }
+        with self.lock:
+            self._values = values
+
+    def _render_samples(self) -> List[str]:
+        with self.lock:
+            values = dict(self._values)
+
+        return [
+            f'{self.name}'
+            f'{_format_labels(self.label_names, label_values)} '
+            f'{_format_value(value)}'
+            for label_values, value in values.items()
+        ]
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        label_names=(),
+        buckets=DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+        self._counts = {}
+        self._sums = {}
+
+    def observe(self, value: float, **labels):
+        label_values = self._get_label_values(labels)
+        with self.lock:
+            if label_values not in self._counts:
+                self._counts[label_values] = [0] * len(self.buckets)
+                self._sums[label_values] = 0
+
+            counts = self._counts[label_values]
+            for position, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    counts[position] += 1
+                    break
+            self._sums[label_values] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_samples(self) -> List[str]:
+        with self.lock:
+            counts = {
+                label_values: list(bucket_counts)
+                for label_values, bucket_counts in self._counts.items()
+            }
+            sums = dict(self._sums)
+
+        lines = []
+        for label_values, bucket_counts in counts.items():
+            cumulative_count = 0
+            for bucket, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative_count += bucket_count
+                labels = _format_labels(
+                    self.label_names,
+                    label_values,
+                    ('le', _format_value(bucket)),
+                )
+                lines.append(f'{self.name}_bucket{labels} {cumulative_count}')
+
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(
+                f'{self.name}_sum{labels} '
+                f'{_format_value(sums[label_values])}'
+            )
+            lines.append(f'{self.name}_count{labels} {cumulative_count}')
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(
+    Counter(
+        'stopover_requests_total',
+        'Requests handled by method and status.',
+        ('method', 'status'),
+    )
+)
+
+REQUEST_SECONDS = REGISTRY.register(
+    Histogram(
+        'stopover_request_duration_seconds',
+        'Time spent handling requests by method.',
+        ('method', ),
+    )
+)
+
+STORE_SECONDS = REGISTRY.register(
+    Histogram(
+        'stopover_store_operation_duration_seconds',
+        'Time spent in RocksDB calls by operation.',
+        ('operation', ),
+    )
+)
+
+LOCK_WAIT_SECONDS = REGISTRY.register(
+    Histogram(
+        'stopover_lock_wait_seconds',
+        'Time spent waiting to acquire locks.',
+        ('lock', ),
+    )
+)
+
+TRANSFERRED_BYTES = REGISTRY.register(
+    Counter(
+        'stopover_transferred_bytes_total',
+        'Bytes received and sent, on the wire and once decompressed.',
+        ('direction', 'encoding'),
+    )
+)
+
+CONSUMER_LAG = REGISTRY.register(
+    Gauge(
+        'stopover_consumer_lag_messages',
+        'Head index minus the committed offset of each receiver group.',
+        ('stream', 'partition', 'receiver_group'),
+    )
+)
+
+PARTITION_HANDLES = REGISTRY.register(
+    Gauge(
+        'stopover_partition_handles',
+        'Partition handles open, reused, opened and evicted.',
+        ('event', ),
+    )
+)
+
+
+class MetricsResource:
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def on_get(self, request, response):
+        self.broker.update_metrics()
+        response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        response.text = REGISTRY.render()
+
+
+@contextmanager
+def acquire(lock: Lock, name: str):
+    start = time.perf_counter()
+    with lock:
+        LOCK_WAIT_SECONDS.observe(time.perf_counter() - start, lock=name)
+        yield
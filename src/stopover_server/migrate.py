@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from .partition import Partition
+from .storage import (
+    PartitionStore,
+    StreamDatabase,
+    get_stream_database_path,
+)
+from easyrocks import WriteBatch
+from os import listdir, makedirs, rename
+import argparse
+import logging
+import yaml
+
+MIGRATION_BATCH_SIZE = 10000
+
+
+def migrate_stream(data_dir: str, stream: str):
+    # Copies every partition of the stream into a column family of a single
+    # database and moves the original directories into `migrated`
+    stream_path = f'{data_dir}/streams/{stream}'
+
+    partition_numbers = []
+    for partition_number in sorted(listdir(stream_path)):
+        try:
+            partition_numbers.append(int(partition_number))
+        except ValueError:
+            continue
+
+    if not partition_numbers:
+        raise FileNotFoundError(f'no partitions found in {stream_path}')
+
+    database = StreamDatabase(
+        get_stream_database_path(data_dir, stream),
+        Partition.get_store_options(create_if_missing=True),
+    )
+
+    migrated_path = f'{stream_path}/migrated'
+    try:
+        makedirs(migrated_path)
+    except FileExistsError:
+        pass
+
+    for partition_number in partition_numbers:
+        logging.info(f'migrating {stream}/{partition_number}')
+
+        partition_path = f'{stream_path}/{partition_number}'
+        source_store = PartitionStore(
+            path=partition_path,
+            opts=Partition.get_store_options(),
+        )
+        target_store = database.get_store(
+            partition_number,
+            create_if_missing=True,
+        )
+
+        copied_keys = 0
+        write_batch = WriteBatch()
+        for key, value_bytes in source_store.iteritems(b''):
+            target_store.put_bytes(key, value_bytes, write_batch=write_batch)
+            copied_keys += 1
+
+            if copied_keys % MIGRATION_BATCH_SIZE == 0:
+                target_store.commit(write_batch)
+                write_batch = WriteBatch()
+        target_store.commit(write_batch)
+
+        source_store.close()
+        rename(partition_path, f'{migrated_path}/{partition_number}')
+        logging.info(f'copied {copied_keys} keys')
+
+    logging.info(
+        f'set storage_layout: stream for the stream "{stream}" '
+        'before starting the broker'
+    )
+
+
+def main():
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(
+        format='%(asctime)-15s [%(levelname)s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    parser = argparse.ArgumentParser(
+        description='Migrate streams to the column family storage layout. '
+        'The broker must be stopped.'
+    )
+    parser.add_argument('streams', nargs='+')
+    parser.add_argument('--config', default='./config.yaml')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as input_file:
+        config = yaml.safe_load(input_file)
+
+    for stream in args.streams:
+        migrate_stream(config['global']['data_dir'], stream)
+
+
+if __name__ == "__main__":
+    main()
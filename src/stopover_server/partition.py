@@ -1,15 +1,56 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from . import utils
+from . import metrics
+from .storage import PartitionStore
 from os import makedirs
-from easyrocks import RocksDB, WriteBatch, CompressionType
-from easyrocks.utils import int_to_padded_bytes
-from threading import Lock
+from easyrocks import WriteBatch, CompressionType
+from easyrocks.utils import int_to_padded_bytes, bytes_to_int
+from easyrocks.utils import pack as pack_value
+from easyrocks.utils import unpack as unpack_value
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+from itertools import islice
+from threading import Condition, Event, Lock
 import logging
-from typing import Dict
+import struct
+import time
+from typing import Dict, Generator, List, Tuple
 
 UINT_BYTES = 8
 MAX_UINT = 2**(UINT_BYTES * 8) - 1
+PRUNE_BATCH_SIZE = 10000
+DEFAULT_MAX_PRODUCERS = 10000
+TIMESTAMP_INTERVAL_MS = 60000
+
+# Binary records start with a byte that never begins a MessagePack value,
+# followed by the timestamp and the flags of the message and its payload
+RECORD_MAGIC = b'\xc1'
+RECORD_HEADER = struct.Struct('>QB')
+RECORD_HEADER_SIZE = len(RECORD_MAGIC) + RECORD_HEADER.size
+
+
+class DURABILITY:
+    # Every write is synced on its own
+    STRICT = 'strict'
+    # Concurrent writes share a single sync
+    GROUP = 'group'
+    # Writes are never synced
+    RELAXED = 'relaxed'
+
+
+class STORAGE_FORMAT:
+    # MessagePack map with the value and the timestamp
+    MSGPACK = 'msgpack'
+    # Binary header followed by the raw payload
+    BINARY = 'binary'
+
+
+class FLAG:
+    # The payload is the MessagePack encoding of a value that is not bytes
+    PACKED = 0x01
+    # The producer compressed the value, which is stored as it is
+    COMPRESSED = 0x02
 
 
 class PartitionItem:
@@ -18,7 +59,8 @@ class PartitionItem:
         self,
         value: bytes = None,
         timestamp: int = None,
-        item_dict: Dict = None
+        item_dict: Dict = None,
+        compressed: bool = False,
     ):
         if item_dict is not None:
             self._load_from_dict(item_dict)
@@ -27,6 +69,7 @@ class PartitionItem:
                 raise ValueError('the timestamp was not provided')
             self._value = value
             self._timestamp = timestamp
+            self._compressed = compressed
 
     @property
     def value(self):
@@ -36,37 +79,137 @@ class PartitionItem:
     def timestamp(self):
         return self._timestamp
 
+    @property
+    def compressed(self):
+        return self._compressed
+
     @property
     def dict(self):
-        return {'value': self._value, 'timestamp': self._timestamp}
+        item_dict = {'value': self._value, 'timestamp': self._timestamp}
+        # Only flagged messages carry the field
+        if self._compressed:
+            item_dict['compressed'] = True
+        return item_dict
 
     def _load_from_dict(self, value: Dict):
         self._value = value['value']
         self._timestamp = value['timestamp']
+        self._compressed = value['compressed'] if 'compressed' in value \
+            else False
+
+
+class PendingWrite:
+
+    def __init__(
+        self,
+        items: List[PartitionItem],
+        producer_id: str = None,
+        sequence: int = None,
+    ):
+        self.items = items
+        self.producer_id = producer_id
+        self.sequence = sequence
+        self.indexes = None
+        self.error = None
+        self.done = Event()
 
 
 class Partition:
     MESSAGE = b'\x00'
     INDEX = b'\x01'
     OFFSET = b'\x02'
+    TIMESTAMP = b'\x03'
+    PRODUCER = b'\x04'
 
     def __init__(
         self,
         stream: str,
         number: int,
         data_dir: str,
-        create_if_missing: bool = False
+        create_if_missing: bool = False,
+        durability: str = DURABILITY.STRICT,
+        group_commit_ms: float = 2,
+        group_commit_messages: int = 256,
+        store_options: Dict = None,
+        store=None,
+        storage_format: str = STORAGE_FORMAT.BINARY,
+        max_producers: int = DEFAULT_MAX_PRODUCERS,
     ):
+        if durability not in (
+            DURABILITY.STRICT,
+            DURABILITY.GROUP,
+            DURABILITY.RELAXED,
+        ):
+            raise ValueError(f'unknown durability "{durability}"')
+
+        if storage_format not in (
+            STORAGE_FORMAT.MSGPACK,
+            STORAGE_FORMAT.BINARY,
+        ):
+            raise ValueError(f'unknown storage format "{storage_format}"')
+
+        # Serializes the writers, while readers rely on the immutability of
+        # the committed messages and never take it
         self.lock = Lock()
+        self._offsets_lock = Lock()
+        self._waiters_lock = Lock()
+        self._waiters = set()
+
+        # Readers and open iterators, which the pool must not close
+        self._readers_lock = Lock()
+        self._readers = 0
         self.stream = stream
         self.number = number
-        partition_path = f'{data_dir}/streams/{stream}/{self.number}'
-
-        try:
-            makedirs(partition_path)
-        except FileExistsError:
-            pass
+        self.durability = durability
+        self.storage_format = storage_format
+        self.group_commit_ms = group_commit_ms
+        self.max_producers = max_producers
+        self.group_commit_messages = group_commit_messages
+
+        # Column family of a database shared by the whole stream
+        if store is None:
+            partition_path = f'{data_dir}/streams/{stream}/{self.number}'
+
+            try:
+                makedirs(partition_path)
+            except FileExistsError:
+                pass
+
+            opts = Partition.get_store_options(
+                create_if_missing,
+                store_options,
+            )
+            store = PartitionStore(path=partition_path, opts=opts)
+
+        self._store = store
+
+        # In-memory copies of the head index and the group offsets, loaded
+        # once and written through on every change
+        self._index = self._load_index()
+        self._offsets = self._load_offsets()
+
+        # Watermark of the oldest retained message, moved forward by prune
+        self._oldest_index = self._load_oldest_index()
+
+        # Last write of the most recent producers, loaded on demand
+        self._producers = OrderedDict()
+
+        # Bounds of the sparse timestamp index, which maps the start of every
+        # interval to the first message written within it
+        self._first_timestamp_bucket = self._load_first_timestamp_bucket()
+        self._last_timestamp_bucket = self._load_last_timestamp_bucket()
+
+        # Writes waiting for the next group commit
+        self._group_condition = Condition()
+        self._group = []
+        self._group_size = 0
+        self._group_leader = False
 
+    @staticmethod
+    def get_store_options(
+        create_if_missing: bool = False,
+        store_options: Dict = None,
+    ) -> Dict:
         opts = {
             'create_if_missing': create_if_missing,
             'compression': CompressionType.lz4_compression,
@@ -76,90 +219,697 @@ class Partition:
                 'compression_size_percent': 0,
             }
         }
-        self._store = RocksDB(path=partition_path, opts=opts)
+        if store_options is not None:
+            opts.update(store_options)
+        return opts
+
+    @property
+    def is_idle(self) -> bool:
+        with self._waiters_lock:
+            has_waiters = bool(self._waiters)
+        with self._readers_lock:
+            has_readers = self._readers > 0
+        return (
+            not has_waiters and not has_readers and not self.lock.locked()
+            and not self._offsets_lock.locked()
+        )
+
+    def close(self):
+        with metrics.acquire(self.lock, 'partition'):
+            with metrics.acquire(self._offsets_lock, 'partition_offsets'):
+                self._store.close()
+
+    def put(
+        self,
+        item: PartitionItem,
+        producer_id: str = None,
+        sequence: int = None,
+    ) -> int:
+        return self.put_many([item], producer_id, sequence)[0]
 
-    def put(self, item: PartitionItem) -> int:
-        with self.lock:
-            index = self._get_index() + 1
-            message_key = self._get_message_key(index)
+    def put_many(
+        self,
+        items: List[PartitionItem],
+        producer_id: str = None,
+        sequence: int = None,
+    ) -> List[int]:
+        if producer_id is not None and sequence is None:
+            raise ValueError('the sequence was not provided')
+
+        pending_write = PendingWrite(items, producer_id, sequence)
+        if self.durability == DURABILITY.GROUP:
+            self._put_grouped(pending_write)
+        else:
+            self._write([pending_write])
+
+        if pending_write.error is not None:
+            raise pending_write.error
 
+        self._notify_waiters()
+        return pending_write.indexes
+
+    def _write(self, pending_writes: List[PendingWrite]):
+        with metrics.acquire(self.lock, 'partition'):
             write_batch = WriteBatch()
-            self._store.put(message_key, item.dict, write_batch=write_batch)
-            self._increase_index(write_batch)
-            self._store.commit(write_batch)
+            staged_write = self._stage(pending_writes, write_batch)
+
+            # Nothing is committed for a batch of retries
+            if staged_write[0]:
+                self._commit(write_batch)
+            self._apply(staged_write)
+
+    @staticmethod
+    def put_together(
+        partitions: List['Partition'],
+        items_by_partition: List[List[PartitionItem]],
+        producer_id: str = None,
+        sequence: int = None,
+    ) -> List[List[int]]:
+        # Partitions stored in the same database are written with a single
+        # commit, holding their locks in a fixed order
+        if producer_id is not None and sequence is None:
+            raise ValueError('the sequence was not provided')
+
+        pending_writes = [
+            PendingWrite(items, producer_id, sequence)
+            for items in items_by_partition
+        ]
+
+        with ExitStack() as stack:
+            for partition in sorted(
+                    partitions,
+                    key=lambda partition: partition.number,
+            ):
+                stack.enter_context(
+                    metrics.acquire(partition.lock, 'partition')
+                )
+
+            write_batch = WriteBatch()
+            staged_writes = [
+                partition._stage([pending_write], write_batch)
+                for partition, pending_write in zip(partitions, pending_writes)
+            ]
+
+            if any(staged_write[0] for staged_write in staged_writes):
+                partitions[0]._commit(write_batch)
+            for partition, staged_write in zip(partitions, staged_writes):
+                partition._apply(staged_write)
+
+        for pending_write in pending_writes:
+            if pending_write.error is not None:
+                raise pending_write.error
+
+        for partition in partitions:
+            partition._notify_waiters()
+        return [pending_write.indexes for pending_write in pending_writes]
+
+    def _stage(
+        self,
+        pending_writes: List[PendingWrite],
+        write_batch: WriteBatch,
+    ) -> tuple:
+        # Adds the writes to the batch without changing the partition, which
+        # is only updated by _apply once the batch is committed
+        next_index = self._get_index() + 1
+        timestamp_bucket = self._last_timestamp_bucket
+
+        written = []
+        retried = []
+        producers = {}
+        for pending_write in pending_writes:
+            producer_id = pending_write.producer_id
+
+            # Retries return the indexes of the original write, which may
+            # belong to this same batch
+            if producer_id is not None:
+                producer = producers[producer_id] \
+                    if producer_id in producers \
+                    else self._get_producer(producer_id)
+                if (producer is not None
+                        and pending_write.sequence <= producer[0]):
+                    retried.append((pending_write, producer))
+                    continue
+
+            first_index = next_index
+            for item in pending_write.items:
+                message_key = self._get_message_key(next_index)
+                self._store.put_bytes(
+                    message_key,
+                    self._encode_item(item),
+                    write_batch=write_batch,
+                )
+
+                item_bucket = self._get_timestamp_bucket(item.timestamp)
+                if timestamp_bucket is None or item_bucket > timestamp_bucket:
+                    timestamp_bucket = item_bucket
+                    timestamp_key = self._get_timestamp_key(timestamp_bucket)
+                    self._store.put(
+                        timestamp_key, next_index, write_batch=write_batch
+                    )
+                next_index += 1
+
+            written.append((pending_write, first_index, next_index))
+
+            # Written in the same batch as the messages
+            if producer_id is not None:
+                producer = [
+                    pending_write.sequence,
+                    first_index,
+                    len(pending_write.items),
+                ]
+                producers[producer_id] = producer
+                self._store.put(
+                    self._get_producer_key(producer_id),
+                    producer,
+                    write_batch=write_batch,
+                )
+
+        if written:
+            self._set_index(next_index - 1, write_batch)
+
+        return written, retried, producers, timestamp_bucket
+
+    def _apply(self, staged_write: tuple):
+        written, retried, producers, timestamp_bucket = staged_write
+
+        if written:
+            self._index = written[-1][2] - 1
+            if self._oldest_index is None:
+                self._oldest_index = written[0][1]
+
+            if timestamp_bucket != self._last_timestamp_bucket:
+                self._last_timestamp_bucket = timestamp_bucket
+                if self._first_timestamp_bucket is None:
+                    self._first_timestamp_bucket = timestamp_bucket
+
+            for pending_write, first_index, next_index in written:
+                pending_write.indexes = list(range(first_index, next_index))
+
+            for producer_id, producer in producers.items():
+                self._cache_producer(producer_id, producer)
+
+        for pending_write, producer in retried:
+            self._resolve_duplicate(pending_write, producer)
+
+    def _put_grouped(self, pending_write: PendingWrite):
+        with self._group_condition:
+            self._group.append(pending_write)
+            self._group_size += len(pending_write.items)
+
+            # The first writer of a group collects the writes arriving
+            # within the window and commits them all at once
+            is_leader = not self._group_leader
+            if is_leader:
+                self._group_leader = True
+                deadline = time.time() + self.group_commit_ms / 1000
+                while self._group_size < self.group_commit_messages:
+                    remaining_seconds = deadline - time.time()
+                    if remaining_seconds <= 0:
+                        break
+                    self._group_condition.wait(remaining_seconds)
+
+                group = self._group
+                self._group = []
+                self._group_size = 0
+                self._group_leader = False
+
+            elif self._group_size >= self.group_commit_messages:
+                self._group_condition.notify()
+
+        if is_leader:
+            self._write_group(group)
+
+        pending_write.done.wait()
+
+    def _write_group(self, group: List[PendingWrite]):
+        try:
+            self._write(group)
+
+        except Exception as error:
+            for pending_write in group:
+                if pending_write.indexes is None:
+                    pending_write.error = error
 
-            return index
+        finally:
+            for pending_write in group:
+                pending_write.done.set()
 
     def get(self, receiver_group: str, index=None) -> dict:
-        with self.lock:
-            if index is not None:
-                receiver_index = index
-            else:
-                receiver_index = self._get_offset(receiver_group) + 1
+        with self._reading():
+            return self._get(receiver_group, index)
+
+    def _get(self, receiver_group: str, index=None) -> dict:
+        if index is not None:
+            receiver_index = index
             partition_item = self._get_by_index(receiver_index)
 
-            # Fast-forward the offset if messages were pruned
-            if index is None and partition_item is None:
-                current_index = self._get_index()
-                while (partition_item is None
-                       and receiver_index < current_index):
-                    self._increase_offset(receiver_group)
-                    receiver_index = self._get_offset(receiver_group) + 1
-                    partition_item = self._get_by_index(receiver_index)
-
-            if partition_item is None:
+        else:
+            # Messages are visible once the head index covers them
+            head_index = self._get_index()
+            offset = self._get_offset(receiver_group)
+            if offset >= head_index:
                 return None
 
-            partition_item_dict = partition_item.dict
-            partition_item_dict['index'] = receiver_index
-            return partition_item_dict
+            # Everything up to the head was pruned
+            start_index = self._get_start_index(offset)
+            if start_index is None:
+                receiver_index = head_index + 1
+                partition_item = None
+
+            else:
+                # A single seek finds the first live message
+                receiver_index, partition_item = \
+                    self._seek_item(start_index)
+                if partition_item is None or receiver_index > head_index:
+                    receiver_index = head_index + 1
+                    partition_item = None
+
+            # Fast-forward the offset if messages were pruned
+            if receiver_index > offset + 1:
+                self._fast_forward(receiver_group, offset, receiver_index - 1)
+
+        if partition_item is None:
+            return None
+
+        partition_item_dict = partition_item.dict
+        partition_item_dict['index'] = receiver_index
+        return partition_item_dict
+
+    def get_many(
+        self,
+        receiver_group: str,
+        max_messages: int,
+        max_bytes: int = None,
+    ) -> List[dict]:
+        items = []
+        total_bytes = 0
+
+        start_index = self._get_offset(receiver_group) + 1
+        messages = self.iter_messages(start_index)
+        try:
+            for partition_item_dict in islice(messages, max_messages):
+                # At least one message is always returned
+                total_bytes += partition_item_dict['size']
+                if (max_bytes is not None and items
+                        and total_bytes > max_bytes):
+                    break
+
+                items.append(partition_item_dict)
+        finally:
+            messages.close()
 
-    def commit(self, offset: int, receiver: str):
-        with self.lock:
+        return items
+
+    def get_range(self, start_index: int, max_messages: int) -> List[dict]:
+        messages = self.iter_messages(start_index)
+        try:
+            return list(islice(messages, max_messages))
+        finally:
+            messages.close()
+
+    def iter_messages(self, start_index: int) -> Generator:
+        # Messages from the start index up to the head when called, keeping
+        # the partition in use until the generator is exhausted or closed
+        with self._reading():
+            head_index = self._get_index()
+            start_index = self._get_start_index(start_index - 1)
+            if start_index is None:
+                return
+            message_key = self._get_message_key(start_index)
+
+            # A single seek also skips any pruned gap after the start index
+            for key, value_bytes in self._store.iteritems(message_key):
+                if key[:1] != Partition.MESSAGE:
+                    break
+
+                index = bytes_to_int(key[1:])
+                if index > head_index:
+                    break
+
+                partition_item = self._decode_item(value_bytes)
+                partition_item_dict = partition_item.dict
+                partition_item_dict['index'] = index
+                partition_item_dict['size'] = len(value_bytes)
+                yield partition_item_dict
+
+    def get_offset(self, receiver_group: str) -> int:
+        return self._get_offset(receiver_group)
+
+    def commit(self, offset: int, receiver: str, cumulative: bool = False):
+        with metrics.acquire(self._offsets_lock, 'partition_offsets'):
+            if cumulative:
+                index = self._get_index()
+                if offset > index:
+                    raise ValueError(
+                        f'trying to commit offset {offset} '
+                        f'beyond the partition head {index}'
+                    )
+
+                # Already committed
+                if offset <= self._get_offset(receiver):
+                    return
+
+                self._set_offset(receiver, offset)
+                return
+
+            # Stale offsets continue from the oldest retained message
             expected_offset = self._get_offset(receiver) + 1
+            oldest_index = self._get_oldest_index()
+            if oldest_index is not None and expected_offset < oldest_index:
+                expected_offset = oldest_index
             if offset != expected_offset:
                 raise ValueError(
                     f'trying to commit offset {offset} '
                     f'but expecting {expected_offset}'
                 )
-            self._increase_offset(receiver)
+            self._set_offset(receiver, offset)
 
     def set_offset(self, receiver: str, offset: int):
-        with self.lock:
+        with metrics.acquire(self._offsets_lock, 'partition_offsets'):
             index = self._get_index()
             if offset >= index:
                 offset = index - 1
-            offset_key = self._get_offset_key(receiver)
-            self._store.put(offset_key, offset)
 
-    def prune(self, ttl: int):
+            oldest_index = self._get_oldest_index()
+            if oldest_index is not None and offset < oldest_index - 1:
+                offset = oldest_index - 1
+
+            self._set_offset(receiver, offset)
+
+    def get_lags(self) -> Dict[str, int]:
+        return {
+            receiver_group: self._get_lag(offset)
+            for receiver_group, offset in dict(self._offsets).items()
+        }
+
+    def describe(self) -> dict:
+        index = self._get_index()
+        oldest_index = self._get_oldest_index()
+
+        if oldest_index is None:
+            messages = 0
+        else:
+            messages = index - oldest_index + 1
+
+        receiver_groups = {
+            receiver_group: {
+                'offset': offset,
+                'lag': self._get_lag(offset),
+            }
+            for receiver_group, offset in dict(self._offsets).items()
+        }
+
+        return {
+            'head_index': index,
+            'oldest_index': oldest_index,
+            'messages': messages,
+            'receiver_groups': receiver_groups,
+        }
+
+    def add_waiter(self, event: Event):
+        with self._waiters_lock:
+            self._waiters.add(event)
+
+    def remove_waiter(self, event: Event):
+        with self._waiters_lock:
+            self._waiters.discard(event)
+
+    def prune(self, ttl: int, compact: bool = False):
+        with self._reading():
+            self._prune(ttl, compact)
+
+    def _prune(self, ttl: int, compact: bool = False):
         ttl *= 1000  # milliseconds
 
-        current_timestamp = utils.get_timestamp_ms()
-        keys_to_delete = []
+        min_timestamp = utils.get_timestamp_ms() - ttl
 
-        with self.lock:
-            for key, value in self._store.scan(prefix=Partition.MESSAGE):
+        oldest_index = self._get_oldest_index()
+        if oldest_index is None:
+            return
 
-                # Backwards compatibility
-                if isinstance(value, bytes):
-                    value = utils.unpack(value)
+        expiry_index = self.find_index(min_timestamp)
+        if expiry_index <= oldest_index:
+            return
 
-                item_timestamp = PartitionItem(item_dict=value).timestamp
-                if current_timestamp - item_timestamp < ttl:
+        # Moved before deleting, so that readers skip the expired range
+        with metrics.acquire(self.lock, 'partition'):
+            if expiry_index > self._get_index():
+                self._oldest_index = None
+            else:
+                self._oldest_index = expiry_index
+
+        logging.debug(
+            f'deleting messages [{oldest_index}, {expiry_index}) '
+            f'of {self.stream}/{self.number}'
+        )
+
+        # Expired messages are never read again, so they are deleted in
+        # chunks without blocking producers or consumers
+        for first_index in range(oldest_index, expiry_index, PRUNE_BATCH_SIZE):
+            last_index = min(first_index + PRUNE_BATCH_SIZE, expiry_index)
+            write_batch = WriteBatch()
+            for index in range(first_index, last_index):
+                message_key = self._get_message_key(index)
+                self._store.delete(message_key, write_batch=write_batch)
+            self._store.commit(write_batch)
+
+        self._prune_timestamps(min_timestamp)
+        self._prune_producers(expiry_index)
+
+        if compact:
+            self._store.compact_range(
+                begin=self._get_message_key(oldest_index),
+                end=self._get_message_key(expiry_index),
+            )
+
+    def find_index(self, timestamp: int) -> int:
+        # First index whose message is not older than the timestamp
+        high = self._get_index() + 1
+        bucket = self._get_timestamp_bucket(timestamp)
+
+        # Messages written before the first indexed interval are searched
+        # from the oldest one
+        if (self._first_timestamp_bucket is None
+                or bucket <= self._first_timestamp_bucket):
+            low = self._get_oldest_index()
+            if low is None:
+                return high
+            return self._search_timestamp(low, high, timestamp)
+
+        # Every message of an earlier interval is older
+        low = None
+        timestamp_key = self._get_timestamp_key(bucket)
+        for key, value_bytes in self._store.iteritems(timestamp_key):
+            if key[:1] == Partition.TIMESTAMP:
+                low = unpack_value(value_bytes)
+            break
+
+        if low is None:
+            return high
+        return self._search_timestamp(low, high, timestamp)
+
+    def seek(self, receiver_group: str, timestamp: int) -> int:
+        with self._reading():
+            index = self.find_index(timestamp)
+        with metrics.acquire(self._offsets_lock, 'partition_offsets'):
+            self._set_offset(receiver_group, index - 1)
+        return index
+
+    @contextmanager
+    def _reading(self):
+        # Reads take no partition lock, so they are counted instead
+        with self._readers_lock:
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._readers_lock:
+                self._readers -= 1
+
+    def _seek_item(self, index: int) -> Tuple[int, PartitionItem]:
+        # First message at or after the index
+        message_key = self._get_message_key(index)
+        with metrics.STORE_SECONDS.time(operation='seek'):
+            for key, value_bytes in self._store.iteritems(message_key):
+                if key[:1] != Partition.MESSAGE:
                     break
-                keys_to_delete.append(key)
+                return bytes_to_int(key[1:]), self._decode_item(value_bytes)
+        return None, None
+
+    def _get_start_index(self, offset: int) -> int:
+        # Pruned messages are skipped without seeking over their tombstones
+        oldest_index = self._get_oldest_index()
+        if oldest_index is None:
+            return None
+        return max(offset + 1, oldest_index)
+
+    def _fast_forward(self, receiver: str, offset: int, next_offset: int):
+        # Skipped in one write, unless the offset moved in the meantime
+        with metrics.acquire(self._offsets_lock, 'partition_offsets'):
+            if self._get_offset(receiver) == offset:
+                self._set_offset(receiver, next_offset)
+
+    def _load_oldest_index(self) -> int:
+        for key in self._store.iterkeys(Partition.MESSAGE):
+            if key[:1] != Partition.MESSAGE:
+                break
+            return bytes_to_int(key[1:])
+        return None
+
+    def _search_timestamp(self, low: int, high: int, timestamp: int) -> int:
+        # Binary search of the first message not older than the timestamp,
+        # relying on timestamps growing with the indexes
+        while low < high:
+            middle = (low + high) // 2
+            partition_item = self._get_by_index(middle)
+            if (partition_item is None
+                    or partition_item.timestamp < timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
 
-            for key in keys_to_delete:
-                logging.debug(f'Deleting {key}')
-                self._store.delete(key)
+    def _prune_timestamps(self, min_timestamp: int):
+        stop_key = self._get_timestamp_key(
+            self._get_timestamp_bucket(min_timestamp)
+        )
+
+        write_batch = WriteBatch()
+        for key in self._store.iterkeys(Partition.TIMESTAMP):
+            if key[:1] != Partition.TIMESTAMP or key >= stop_key:
+                break
+            self._store.delete(key, write_batch=write_batch)
+        self._store.commit(write_batch)
+
+        with metrics.acquire(self.lock, 'partition'):
+            self._first_timestamp_bucket = \
+                self._load_first_timestamp_bucket()
+
+    def _prune_producers(self, expiry_index: int):
+        # Producers whose last write was pruned can no longer retry it
+        producer_ids = []
+        for key, value_bytes in self._store.iteritems(Partition.PRODUCER):
+            if key[:1] != Partition.PRODUCER:
+                break
+            _, first_index, count = unpack_value(value_bytes)
+            if first_index + count <= expiry_index:
+                producer_ids.append(key[1:].decode('utf-8'))
+
+        if not producer_ids:
+            return
+
+        with metrics.acquire(self.lock, 'partition'):
+            write_batch = WriteBatch()
+            for producer_id in producer_ids:
+                producer = self._producers[producer_id] \
+                    if producer_id in self._producers \
+                    else self._load_producer(producer_id)
+
+                # Written again in the meantime
+                if producer is None or producer[1] + producer[2] > \
+                        expiry_index:
+                    continue
+
+                self._store.delete(
+                    self._get_producer_key(producer_id),
+                    write_batch=write_batch,
+                )
+                self._producers.pop(producer_id, None)
+            self._store.commit(write_batch)
+
+    def _get_producer(self, producer_id: str) -> List[int]:
+        if producer_id in self._producers:
+            self._producers.move_to_end(producer_id)
+            return self._producers[producer_id]
+
+        producer = self._load_producer(producer_id)
+        if producer is not None:
+            self._cache_producer(producer_id, producer)
+        return producer
+
+    def _load_producer(self, producer_id: str) -> List[int]:
+        producer_key = self._get_producer_key(producer_id)
+        with metrics.STORE_SECONDS.time(operation='get'):
+            return self._store.get(producer_key)
+
+    def _cache_producer(self, producer_id: str, producer: List[int]):
+        # Idle producers are evicted first and reloaded from the store
+        self._producers[producer_id] = producer
+        self._producers.move_to_end(producer_id)
+        while len(self._producers) > self.max_producers:
+            self._producers.popitem(last=False)
+
+    @staticmethod
+    def _resolve_duplicate(pending_write: PendingWrite, producer: List[int]):
+        sequence, first_index, count = producer
+        if (pending_write.sequence != sequence
+                or len(pending_write.items) != count):
+            pending_write.error = ValueError(
+                f'sequence {pending_write.sequence} of producer '
+                f'"{pending_write.producer_id}" is older than '
+                f'the last written sequence {sequence}'
+            )
+            return
+        pending_write.indexes = list(range(first_index, first_index + count))
+
+    def _commit(self, write_batch: WriteBatch):
+        with metrics.STORE_SECONDS.time(operation='commit'):
+            if self.durability == DURABILITY.RELAXED:
+                self._store.write(write_batch, sync=False)
+            else:
+                self._store.commit(write_batch)
+
+    def _notify_waiters(self):
+        with self._waiters_lock:
+            for event in self._waiters:
+                event.set()
 
     def _get_by_index(self, index: int) -> PartitionItem:
         message_key = self._get_message_key(index)
-        value = self._store.get(message_key)
-        if value is None:
+        with metrics.STORE_SECONDS.time(operation='get'):
+            value_bytes = self._store.get_bytes(message_key)
+        if value_bytes is None:
             return None
+        return self._decode_item(value_bytes)
+
+    def _encode_item(self, item: PartitionItem) -> bytes:
+        if self.storage_format == STORAGE_FORMAT.MSGPACK:
+            return pack_value(item.dict)
+
+        value = item.value
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            flags = 0
+            payload = value
+        else:
+            flags = FLAG.PACKED
+            payload = utils.pack(value)
+
+        if item.compressed:
+            flags |= FLAG.COMPRESSED
+
+        header = RECORD_MAGIC + RECORD_HEADER.pack(item.timestamp, flags)
+        return header + payload
+
+    @staticmethod
+    def _decode_item(value_bytes: bytes) -> PartitionItem:
+        # Records written before the binary format are MessagePack maps
+        if value_bytes[:1] != RECORD_MAGIC:
+            return Partition._load_item(unpack_value(value_bytes))
 
+        timestamp, flags = RECORD_HEADER.unpack_from(value_bytes, 1)
+
+        # The payload is sliced without copying it
+        value = memoryview(value_bytes)[RECORD_HEADER_SIZE:]
+        if flags & FLAG.PACKED:
+            value = utils.unpack(value)
+        return PartitionItem(
+            value,
+            timestamp,
+            compressed=bool(flags & FLAG.COMPRESSED),
+        )
+
+    @staticmethod
+    def _load_item(value) -> PartitionItem:
         # Backwards compatibility
         if isinstance(value, bytes):
             value = utils.unpack(value)
@@ -167,39 +917,88 @@ class Partition:
         partition_item = PartitionItem(item_dict=value)
         return partition_item
 
-    def _get_index(self) -> int:
+    def _load_index(self) -> int:
         index_key = Partition.INDEX
         index = self._store.get(index_key)
         if index is None:
             index = -1
         return index
 
+    def _load_offsets(self) -> Dict[str, int]:
+        offsets = {}
+        for key, offset in self._store.scan(prefix=Partition.OFFSET):
+            receiver = key[len(Partition.OFFSET):].decode('utf-8')
+            offsets[receiver] = offset
+        return offsets
+
+    def _load_first_timestamp_bucket(self) -> int:
+        for key in self._store.iterkeys(Partition.TIMESTAMP):
+            if key[:1] != Partition.TIMESTAMP:
+                break
+            return bytes_to_int(key[1:])
+        return None
+
+    def _load_last_timestamp_bucket(self) -> int:
+        index = self._get_index()
+        if index < 0:
+            return None
+
+        partition_item = self._get_by_index(index)
+        if partition_item is None:
+            return None
+        return self._get_timestamp_bucket(partition_item.timestamp)
+
+    def _get_index(self) -> int:
+        return self._index
+
+    def _get_oldest_index(self) -> int:
+        return self._oldest_index
+
+    def _get_lag(self, offset: int) -> int:
+        # Pruned messages are not pending
+        oldest_index = self._get_oldest_index()
+        if oldest_index is None:
+            return 0
+        return self._get_index() - max(offset, oldest_index - 1)
+
     def _get_offset(self, receiver: str) -> int:
-        offset_key = self._get_offset_key(receiver)
-        offset = self._store.get(offset_key)
-        if offset is None:
-            offset = -1
-        return offset
+        if receiver not in self._offsets:
+            return -1
+        return self._offsets[receiver]
 
-    def _increase_index(self, write_batch: WriteBatch):
-        next_index = self._get_index() + 1
-        if next_index > MAX_UINT:
-            raise ValueError(next_index)
+    def _set_index(self, index: int, write_batch: WriteBatch):
+        if index > MAX_UINT:
+            raise ValueError(index)
         index_key = Partition.INDEX
-        self._store.put(index_key, next_index, write_batch=write_batch)
+        self._store.put(index_key, index, write_batch=write_batch)
 
-    def _increase_offset(self, receiver: str):
-        next_offset = self._get_offset(receiver) + 1
-        if next_offset > MAX_UINT:
-            raise ValueError(next_offset)
+    def _set_offset(self, receiver: str, offset: int):
         offset_key = self._get_offset_key(receiver)
-        self._store.put(offset_key, next_offset)
+        with metrics.STORE_SECONDS.time(operation='put'):
+            self._store.put(offset_key, offset)
+        self._offsets[receiver] = offset
 
     @staticmethod
     def _get_offset_key(receiver: str) -> bytes:
         offset_key = Partition.OFFSET + bytes(receiver, 'utf-8')
         return offset_key
 
+    @staticmethod
+    def _get_producer_key(producer_id: str) -> bytes:
+        producer_key = Partition.PRODUCER + bytes(producer_id, 'utf-8')
+        return producer_key
+
+    @staticmethod
+    def _get_timestamp_bucket(timestamp: int) -> int:
+        return timestamp - timestamp % TIMESTAMP_INTERVAL_MS
+
+    @staticmethod
+    def _get_timestamp_key(bucket: int) -> bytes:
+        timestamp_key = Partition.TIMESTAMP + int_to_padded_bytes(
+            bucket, UINT_BYTES
+        )
+        return timestamp_key
+
     @staticmethod
     def _get_message_key(index: int) -> bytes:
         message_key = Partition.MESSAGE + int_to_padded_bytes(
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from . import metrics
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+import logging
+import time
+
+DEFAULT_IDLE_TIMEOUT = 300  # seconds
+
+# Partitions handed out this recently are never evicted
+EVICTION_GRACE_SECONDS = 1
+
+
+class PartitionPool:
+
+    def __init__(
+        self,
+        open_partition,
+        max_open_partitions: int = None,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+    ):
+        # Called as open_partition(stream, number, create_if_missing)
+        self._open_partition = open_partition
+        self.max_open_partitions = max_open_partitions
+        self.idle_timeout = idle_timeout
+
+        self.lock = Lock()
+
+        # Least recently used first
+        self._partitions = OrderedDict()
+        self._last_used = {}
+
+        self.hits = 0
+        self.opened = 0
+        self.evicted = 0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'open': len(self._partitions),
+            'hits': self.hits,
+            'opened': self.opened,
+            'evicted': self.evicted,
+        }
+
+    @property
+    def partitions(self) -> list:
+        with self.lock:
+            return list(self._partitions.values())
+
+    def get(
+        self,
+        stream: str,
+        partition_number: int,
+        create_if_missing: bool = False,
+    ):
+        with metrics.acquire(self.lock, 'partition_pool'):
+            return self._get((stream, partition_number), create_if_missing)
+
+    @contextmanager
+    def borrow(
+        self,
+        stream: str,
+        partition_number: int,
+        create_if_missing: bool = False,
+    ):
+        # Partitions opened only for this use are closed right after it in
+        # bounded pools, unless they were used by someone else meanwhile
+        key = (stream, partition_number)
+        with metrics.acquire(self.lock, 'partition_pool'):
+            was_open = key in self._partitions
+            partition = self._get(key, create_if_missing)
+            last_used = self._last_used[key]
+
+        try:
+            yield partition
+        finally:
+            if not was_open and self.max_open_partitions is not None:
+                with metrics.acquire(self.lock, 'partition_pool'):
+                    if (key in self._partitions
+                            and self._partitions[key] is partition
+                            and self._last_used[key] == last_used
+                            and partition.is_idle):
+                        self._close(key)
+
+    def _get(self, key: tuple, create_if_missing: bool):
+        self._last_used[key] = time.time()
+
+        if key in self._partitions:
+            self._partitions.move_to_end(key)
+            self.hits += 1
+        else:
+            stream, partition_number = key
+            self._partitions[key] = self._open_partition(
+                stream,
+                partition_number,
+                create_if_missing,
+            )
+            self.opened += 1
+
+        self._evict(key)
+        return self._partitions[key]
+
+    def _evict(self, used_key: tuple):
+        # Runs on every access, walking from the least recently used
+        # partition only while the pool is over its size or a partition has
+        # not been used for idle_timeout
+        if self.max_open_partitions is None:
+            return
+
+        now = time.time()
+        excess = len(self._partitions) - self.max_open_partitions
+        keys_to_evict = []
+        for key, partition in self._partitions.items():
+            # The partition being returned is the most recent one
+            if key == used_key:
+                break
+
+            last_used = self._last_used[key]
+            if (len(keys_to_evict) >= excess
+                    and last_used > now - self.idle_timeout):
+                break
+
+            # Partitions in use, or just handed out and not used yet, are
+            # kept open even if the pool goes over its size
+            if last_used > now - EVICTION_GRACE_SECONDS:
+                break
+            if partition.is_idle:
+                keys_to_evict.append(key)
+
+        for key in keys_to_evict:
+            self._close(key)
+
+    def _close(self, key: tuple):
+        partition = self._partitions.pop(key)
+        del self._last_used[key]
+        partition.close()
+        self.evicted += 1
+        logging.debug(f'closed idle partition {key[0]}/{key[1]}')
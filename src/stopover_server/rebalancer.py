@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from . import metrics
+from threading import Lock
+from typing import List
+import heapq
+import logging
+import time
+
+
+class GroupAssignment:
+
+    def __init__(self, partition_numbers: List[int]):
+        self.partition_numbers = list(partition_numbers)
+        self.partitions_by_receiver = {}
+
+    def rebalance(self):
+        # Receivers keep the partitions they already own up to their share,
+        # and only the surplus and the orphaned partitions move
+        receivers = self.partitions_by_receiver
+        if not receivers:
+            return
+
+        stream_partitions = set(self.partition_numbers)
+        kept_by_receiver = {}
+        claimed_partitions = set()
+        for receiver in sorted(receivers):
+            kept_partitions = []
+            for partition_number in receivers[receiver]:
+                if (partition_number in stream_partitions
+                        and partition_number not in claimed_partitions):
+                    kept_partitions.append(partition_number)
+                    claimed_partitions.add(partition_number)
+            kept_by_receiver[receiver] = kept_partitions
+
+        # The receivers that own more partitions get the larger shares
+        ordered_receivers = sorted(
+            receivers,
+            key=lambda receiver: (-len(kept_by_receiver[receiver]), receiver),
+        )
+        share, remainder = divmod(
+            len(self.partition_numbers),
+            len(ordered_receivers),
+        )
+
+        free_partitions = [
+            partition_number for partition_number in self.partition_numbers
+            if partition_number not in claimed_partitions
+        ]
+        for position, receiver in enumerate(ordered_receivers):
+            quota = share + 1 if position < remainder else share
+            kept_partitions = kept_by_receiver[receiver]
+            if len(kept_partitions) > quota:
+                free_partitions.extend(kept_partitions[quota:])
+                del kept_partitions[quota:]
+
+        free_partitions.sort(reverse=True)
+        for position, receiver in enumerate(ordered_receivers):
+            quota = share + 1 if position < remainder else share
+            kept_partitions = kept_by_receiver[receiver]
+            while len(kept_partitions) < quota:
+                kept_partitions.append(free_partitions.pop())
+            receivers[receiver] = sorted(kept_partitions)
+
+
+class Rebalancer:
+
+    def __init__(self, receiver_timeout: float):
+        self.receiver_timeout = receiver_timeout
+        self.lock = Lock()
+
+        # Receivers are shared by every stream of their group
+        self._last_seen = {}
+        self._streams_by_receiver = {}
+
+        self._assignments = {}
+
+        # Deadlines of (stream, receiver_group, receiver) memberships, which
+        # are pushed back lazily when they are reached
+        self._expiries = []
+
+    def knock(self, receiver_group: str, receiver: str):
+        with metrics.acquire(self.lock, 'rebalancer'):
+            self._last_seen[(receiver_group, receiver)] = time.time()
+
+    def get_partitions(
+        self,
+        stream: str,
+        receiver_group: str,
+        receiver: str,
+        partition_numbers: List[int],
+    ) -> List[int]:
+        with metrics.acquire(self.lock, 'rebalancer'):
+            assignment_key = (stream, receiver_group)
+            if assignment_key not in self._assignments:
+                self._assignments[assignment_key] = \
+                    GroupAssignment(partition_numbers)
+            assignment = self._assignments[assignment_key]
+
+            if receiver not in assignment.partitions_by_receiver:
+                self._join(stream, receiver_group, receiver, assignment)
+
+            return list(assignment.partitions_by_receiver[receiver])
+
+    def expire(self) -> float:
+        # Returns the seconds until the next deadline
+        with metrics.acquire(self.lock, 'rebalancer'):
+            now = time.time()
+            while self._expiries and self._expiries[0][0] <= now:
+                _, stream, receiver_group, receiver = \
+                    heapq.heappop(self._expiries)
+
+                receiver_key = (receiver_group, receiver)
+                if receiver_key not in self._streams_by_receiver:
+                    continue
+                if stream not in self._streams_by_receiver[receiver_key]:
+                    continue
+
+                deadline = self._last_seen[receiver_key] \
+                    + self.receiver_timeout
+                if deadline > now:
+                    heapq.heappush(
+                        self._expiries,
+                        (deadline, stream, receiver_group, receiver),
+                    )
+                    continue
+
+                self._leave(stream, receiver_group, receiver)
+
+            if not self._expiries:
+                return self.receiver_timeout
+            return max(self._expiries[0][0] - now, 0)
+
+    def _join(
+        self,
+        stream: str,
+        receiver_group: str,
+        receiver: str,
+        assignment: GroupAssignment,
+    ):
+        receiver_key = (receiver_group, receiver)
+        if receiver_key not in self._last_seen:
+            self._last_seen[receiver_key] = time.time()
+        if receiver_key not in self._streams_by_receiver:
+            self._streams_by_receiver[receiver_key] = set()
+        self._streams_by_receiver[receiver_key].add(stream)
+
+        assignment.partitions_by_receiver[receiver] = []
+        assignment.rebalance()
+
+        heapq.heappush(
+            self._expiries,
+            (
+                self._last_seen[receiver_key] + self.receiver_timeout,
+                stream,
+                receiver_group,
+                receiver,
+            ),
+        )
+
+        logging.info(
+            f'receiver "{receiver}" joined the '
+            f'receiver_group "{receiver_group}" '
+            f'for the stream "{stream}"'
+        )
+
+    def _leave(self, stream: str, receiver_group: str, receiver: str):
+        receiver_key = (receiver_group, receiver)
+        self._streams_by_receiver[receiver_key].discard(stream)
+        if not self._streams_by_receiver[receiver_key]:
+            del self._streams_by_receiver[receiver_key]
+            del self._last_seen[receiver_key]
+
+        assignment_key = (stream, receiver_group)
+        assignment = self._assignments[assignment_key]
+        del assignment.partitions_by_receiver[receiver]
+        if assignment.partitions_by_receiver:
+            assignment.rebalance()
+        else:
+            del self._assignments[assignment_key]
+
+        logging.info(
+            f'receiver "{receiver}" kicked from the '
+            f'receiver_group "{receiver_group}" '
+            f'for the stream "{stream}"'
+        )
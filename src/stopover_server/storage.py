@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from easyrocks import RocksDB, WriteBatch, CompressionType
+from easyrocks.utils import pack as pack_value
+from easyrocks.utils import unpack as unpack_value
+from os import makedirs, path
+from threading import Lock
+from typing import Dict, Generator, List
+import logging
+
+
+class LAYOUT:
+    # One RocksDB per partition
+    PARTITION = 'partition'
+    # One RocksDB per stream with a column family per partition
+    STREAM = 'stream'
+
+
+# Block compression algorithms by name
+COMPRESSION = {
+    'none': CompressionType.no_compression,
+    'snappy': CompressionType.snappy_compression,
+    'lz4': CompressionType.lz4_compression,
+    'zstd': CompressionType.zstd_compression,
+}
+
+# Options that RocksDB applies per column family
+COLUMN_FAMILY_OPTIONS = set([
+    'compression',
+    'compression_opts',
+    'compaction_style',
+    'compaction_options_universal',
+    'table_factory',
+    'write_buffer_size',
+    'max_write_buffer_number',
+])
+
+
+def import_rocksdb(option: str):
+    # Classes that easyrocks does not expose come from the python-rocksdb
+    # bindings, which are only imported when an option needs them
+    try:
+        import rocksdb
+    except ImportError:
+        raise ImportError(f'{option} requires the python-rocksdb bindings')
+    return rocksdb
+
+
+def get_stream_database_path(data_dir: str, stream: str) -> str:
+    return f'{data_dir}/streams/{stream}/partitions'
+
+
+def list_partition_numbers(database_path: str) -> List[int]:
+    # Reads the manifest without opening (and locking) the database
+    if not path.exists(f'{database_path}/CURRENT'):
+        return []
+
+    rocksdb = import_rocksdb('storage_layout: stream')
+    partition_numbers = []
+    for name in rocksdb.list_column_families(
+            database_path,
+            rocksdb.Options(),
+    ):
+        try:
+            partition_numbers.append(int(name))
+        except ValueError:
+            continue
+    return sorted(partition_numbers)
+
+
+def _get_key(key) -> bytes:
+    # Column family iterators yield (column_family, key) tuples
+    if isinstance(key, tuple):
+        return key[1]
+    return key
+
+
+class PartitionStore(RocksDB):
+
+    def put_bytes(
+        self,
+        key: bytes,
+        value_bytes: bytes,
+        write_batch: WriteBatch = None,
+    ):
+        # Values that are already serialized
+        if write_batch is not None:
+            write_batch.put(key, value_bytes)
+        else:
+            self.db.put(key, value_bytes, sync=True)
+
+    def get_bytes(self, key: bytes) -> bytes:
+        return self.db.get(key)
+
+    def iterkeys(self, start_key: bytes) -> Generator:
+        iterator = self.db.iterkeys()
+        iterator.seek(start_key)
+        for key in iterator:
+            yield key
+
+    def iteritems(self, start_key: bytes) -> Generator:
+        iterator = self.db.iteritems()
+        iterator.seek(start_key)
+        for key, value_bytes in iterator:
+            yield key, value_bytes
+
+    def write(self, write_batch: WriteBatch, sync: bool = True):
+        self.db.write(write_batch, sync=sync)
+
+    def compact_range(self, begin: bytes, end: bytes):
+        # Not every easyrocks backend exposes manual compactions
+        if not hasattr(self.db, 'compact_range'):
+            logging.warning('easyrocks cannot compact, compaction skipped')
+            return
+        self.db.compact_range(begin=begin, end=end)
+
+
+class ColumnFamilyStore:
+
+    def __init__(self, database: 'StreamDatabase', column_family):
+        self._db = database.db
+        self._column_family = column_family
+
+    def put(self, key: bytes, value, write_batch: WriteBatch = None):
+        if value is None:
+            raise ValueError
+
+        value_bytes = pack_value(value)
+        if write_batch is not None:
+            write_batch.put((self._column_family, key), value_bytes)
+        else:
+            self._db.put((self._column_family, key), value_bytes, sync=True)
+
+    def put_bytes(
+        self,
+        key: bytes,
+        value_bytes: bytes,
+        write_batch: WriteBatch = None,
+    ):
+        # Values that are already serialized
+        if write_batch is not None:
+            write_batch.put((self._column_family, key), value_bytes)
+        else:
+            self._db.put((self._column_family, key), value_bytes, sync=True)
+
+    def get(self, key: bytes):
+        value_bytes = self._db.get((self._column_family, key))
+        if value_bytes is not None:
+            return unpack_value(value_bytes)
+
+    def get_bytes(self, key: bytes) -> bytes:
+        return self._db.get((self._column_family, key))
+
+    def delete(self, key: bytes, write_batch: WriteBatch = None):
+        if write_batch is not None:
+            write_batch.delete((self._column_family, key))
+        else:
+            self._db.delete((self._column_family, key), sync=True)
+
+    def commit(self, write_batch: WriteBatch):
+        if write_batch is None:
+            raise ValueError
+        self._db.write(write_batch, sync=True)
+
+    def write(self, write_batch: WriteBatch, sync: bool = True):
+        self._db.write(write_batch, sync=sync)
+
+    def scan(self, prefix: bytes) -> Generator:
+        for key, value_bytes in self.iteritems(prefix):
+            if key[:len(prefix)] != prefix:
+                return
+            yield key, unpack_value(value_bytes)
+
+    def iterkeys(self, start_key: bytes) -> Generator:
+        iterator = self._db.iterkeys(self._column_family)
+        iterator.seek(start_key)
+        for key in iterator:
+            yield _get_key(key)
+
+    def iteritems(self, start_key: bytes) -> Generator:
+        iterator = self._db.iteritems(self._column_family)
+        iterator.seek(start_key)
+        for key, value_bytes in iterator:
+            yield _get_key(key), value_bytes
+
+    def compact_range(self, begin: bytes, end: bytes):
+        self._db.compact_range(
+            begin=begin,
+            end=end,
+            column_family=self._column_family,
+        )
+
+    def close(self):
+        # The database is shared by the whole stream
+        pass
+
+
+class StreamDatabase:
+
+    def __init__(self, database_path: str, opts: Dict):
+        self.path = database_path
+        self.lock = Lock()
+
+        try:
+            makedirs(database_path)
+        except FileExistsError:
+            pass
+
+        self._rocksdb = import_rocksdb('storage_layout: stream')
+        rocks_opts = self._rocksdb.Options(
+            create_if_missing=True,
+            create_missing_column_families=True,
+        )
+        for key, value in opts.items():
+            setattr(rocks_opts, key, value)
+
+        self._column_family_opts = {
+            key: value
+            for key, value in opts.items() if key in COLUMN_FAMILY_OPTIONS
+        }
+
+        # Every existing column family has to be opened
+        column_families = {}
+        for partition_number in list_partition_numbers(database_path):
+            name = str(partition_number).encode('utf-8')
+            column_families[name] = self._get_column_family_options()
+
+        self.db = self._rocksdb.DB(
+            database_path,
+            rocks_opts,
+            column_families=column_families,
+        )
+
+    def get_store(
+        self,
+        partition_number: int,
+        create_if_missing: bool = False,
+    ) -> ColumnFamilyStore:
+        name = str(partition_number).encode('utf-8')
+
+        with self.lock:
+            column_family = self.db.get_column_family(name)
+            if column_family is None:
+                if not create_if_missing:
+                    raise FileNotFoundError(
+                        f'missing partition {partition_number} '
+                        f'in {self.path}'
+                    )
+                column_family = self.db.create_column_family(
+                    name,
+                    self._get_column_family_options(),
+                )
+
+        return ColumnFamilyStore(self, column_family)
+
+    def _get_column_family_options(self):
+        column_family_opts = self._rocksdb.ColumnFamilyOptions()
+        for key, value in self._column_family_opts.items():
+            setattr(column_family_opts, key, value)
+        return column_family_opts
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from . import metrics
+from . import utils
+from typing import Dict, Generator, Iterator
+import traceback
+import struct
+import json
+
+# Frames are a big-endian uint32 length followed by a MessagePack payload
+FRAME_HEADER = struct.Struct('>I')
+
+# Encoded messages are buffered up to this size before being sent
+CHUNK_SIZE = 64 * 1024
+
+# Every snappy framed stream starts with this chunk
+SNAPPY_STREAM_IDENTIFIER = b'\xff\x06\x00\x00sNaPpY'
+
+# Bytes read from request bodies at once
+READ_SIZE = 64 * 1024
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class FORMAT:
+    # One JSON document per line
+    NDJSON = 'ndjson'
+    # Length-prefixed MessagePack frames
+    MSGPACK = 'msgpack'
+
+
+CONTENT_TYPES = {
+    FORMAT.NDJSON: 'application/x-ndjson',
+    FORMAT.MSGPACK: 'application/x-msgpack',
+}
+
+
+class MessageStream:
+
+    def __init__(
+        self,
+        messages: Iterator[Dict],
+        stream_format: str,
+        end_status: int,
+        error_status: int,
+    ):
+        if stream_format not in CONTENT_TYPES:
+            raise ValueError(f'unknown stream format "{stream_format}"')
+
+        self.messages = messages
+        self.stream_format = stream_format
+        self.content_type = CONTENT_TYPES[stream_format]
+        self.end_status = end_status
+        self.error_status = error_status
+
+    def __iter__(self) -> Generator:
+        # The last record tells clients whether the stream is complete
+        buffer = bytearray()
+        try:
+            for message in self.messages:
+                buffer += self._encode(message)
+                if len(buffer) >= CHUNK_SIZE:
+                    yield self._flush(buffer)
+            buffer += self._encode({'status': self.end_status})
+
+        except Exception as error:
+            traceback.print_exc()
+            buffer += self._encode({
+                'error': str(error),
+                'status': self.error_status,
+            })
+
+        yield self._flush(buffer)
+
+    def close(self):
+        # Called by the server once the response ends, even if the client
+        # went away, so that the partitions being read are released
+        if hasattr(self.messages, 'close'):
+            self.messages.close()
+
+    def _encode(self, message: Dict) -> bytes:
+        if self.stream_format == FORMAT.NDJSON:
+            return json.dumps(message).encode('utf-8') + b'\n'
+
+        frame = utils.pack(message)
+        return FRAME_HEADER.pack(len(frame)) + frame
+
+    @staticmethod
+    def _flush(buffer: bytearray) -> bytes:
+        chunk = bytes(buffer)
+        buffer.clear()
+        metrics.TRANSFERRED_BYTES.inc(
+            len(chunk), direction='out', encoding='plain'
+        )
+        metrics.TRANSFERRED_BYTES.inc(
+            len(chunk), direction='out', encoding='wire'
+        )
+        return chunk
+
+
+class SnappyFramedReader:
+    # File-like view of the decompressed body, read as it arrives
+
+    def __init__(
+        self,
+        stream,
+        prefix: bytes = b'',
+        max_body_size: int = None,
+    ):
+        self.stream = stream
+        self.max_body_size = max_body_size
+        self.body_size = 0
+        self._decompressor = utils.get_stream_decompressor()
+        self._buffer = bytearray()
+        self._feed(prefix)
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            data = self.stream.read(READ_SIZE)
+            if not data:
+                break
+            self._feed(data)
+
+        if size < 0 or size > len(self._buffer):
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def _feed(self, data: bytes):
+        self.body_size += len(data)
+        if self.max_body_size is not None \
+                and self.body_size > self.max_body_size:
+            raise BodyTooLarge(f'the body exceeds {self.max_body_size} bytes')
+
+        plain_data = self._decompressor.decompress(data)
+        metrics.TRANSFERRED_BYTES.inc(
+            len(data), direction='in', encoding='wire'
+        )
+        metrics.TRANSFERRED_BYTES.inc(
+            len(plain_data), direction='in', encoding='plain'
+        )
+        self._buffer += plain_data
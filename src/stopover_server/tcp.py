@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from .broker import Broker
+from .streaming import FRAME_HEADER
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+import traceback
+import msgpack
+import socket
+
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class ERROR:
+    BAD_REQUEST = 400
+    UNAUTHORIZED = 401
+    FORBIDDEN = 403
+    INTERNAL = 500
+
+
+class FrameHandler(StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        broker = self.server.broker
+
+        # Authentication happens once per connection
+        is_authorized = 'auth' not in broker.config
+
+        # Requests can be pipelined; they are answered in order
+        while True:
+            request = self._read_frame()
+            if request is None:
+                return
+
+            request_id = request['id'] if 'id' in request else None
+
+            try:
+                method = request['method']
+                params = request['params']
+                if method == 'auth':
+                    client_id = params['client_id']
+                    client_secret = params['client_secret']
+            except (KeyError, TypeError):
+                self._write_frame({
+                    'id': request_id,
+                    'error': ERROR.BAD_REQUEST,
+                })
+                return
+
+            if method == 'auth':
+                is_authorized = broker.check_credentials(
+                    client_id,
+                    client_secret,
+                ) if 'auth' in broker.config else True
+
+                if not is_authorized:
+                    self._write_frame({
+                        'id': request_id,
+                        'error': ERROR.FORBIDDEN,
+                    })
+                    return
+
+                self._write_frame({'id': request_id, 'data': None})
+                continue
+
+            if not is_authorized:
+                self._write_frame({
+                    'id': request_id,
+                    'error': ERROR.UNAUTHORIZED,
+                })
+                return
+
+            try:
+                response_data = broker.dispatch(method, params)
+
+            except KeyError:
+                self._write_frame({
+                    'id': request_id,
+                    'error': ERROR.BAD_REQUEST,
+                })
+                continue
+
+            except Exception:
+                traceback.print_exc()
+                self._write_frame({'id': request_id, 'error': ERROR.INTERNAL})
+                continue
+
+            self._write_frame({'id': request_id, 'data': response_data})
+
+    def _read_frame(self):
+        header = self.rfile.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return None
+
+        size, = FRAME_HEADER.unpack(header)
+        if size > MAX_FRAME_SIZE:
+            self._write_frame({'id': None, 'error': ERROR.BAD_REQUEST})
+            return None
+
+        payload = self.rfile.read(size)
+        if len(payload) < size:
+            return None
+
+        try:
+            return msgpack.unpackb(payload)
+        except Exception:
+            self._write_frame({'id': None, 'error': ERROR.BAD_REQUEST})
+            return None
+
+    def _write_frame(self, message: dict):
+        payload = msgpack.packb(message)
+        self.wfile.write(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+class FrameServer(ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, broker: Broker):
+        self.broker = broker
+        super().__init__(address, FrameHandler)
@@ -25,6 +25,15 @@ def decompress(message: bytes) -> bytes:
     return snappy.decompress(message)
 
 
+def get_stream_decompressor():
+    # Snappy framing format, which can be decompressed chunk by chunk
+    return snappy.StreamDecompressor()
+
+
+def get_unpacker(file_like, read_size: int) -> msgpack.Unpacker:
+    return msgpack.Unpacker(file_like, read_size=read_size)
+
+
 def get_timestamp_ms() -> int:
     return int(round(time.time() * 1000))
 
@@ -41,21 +50,61 @@ def get_padded_string(string, prefix='', size=64):
     return padded_string
 
 
-# Max 1024 partitions for key-based partition assignment
-def get_partition_number(partition_numbers, key=None):
+class PARTITIONER:
+    # Sum of the SHA3-256 hex digits, kept for existing keyed streams
+    LEGACY = 'legacy'
+    # Jump consistent hash of a 64-bit BLAKE2b digest of the key
+    JUMP = 'jump'
+
+
+def get_key_hash(key: str) -> int:
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def get_jump_bucket(key_hash: int, number_of_buckets: int) -> int:
+    # Lamping & Veach, "A Fast, Minimal Memory, Consistent Hash Algorithm"
+    bucket = -1
+    next_bucket = 0
+    while next_bucket < number_of_buckets:
+        bucket = next_bucket
+        key_hash = (key_hash * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        next_bucket = int((bucket + 1) * (2**31 / ((key_hash >> 33) + 1)))
+    return bucket
+
+
+def get_legacy_partition_index(key: str, number_of_partitions: int) -> int:
+    # Values range from 0 to 960, so at most 961 partitions are reachable
+    value = 0
+    key_hash = string_to_sha3_256(key)
+    for digit in key_hash:
+        value += int(digit, 16)
+    return value % number_of_partitions
+
+
+def get_partition_number(
+    partition_numbers,
+    key=None,
+    partitioner=PARTITIONER.LEGACY,
+):
     # Random partition
     if key is None:
-        partition = random.sample(partition_numbers, 1)[0]
-
+        return random.choice(partition_numbers)
+
+    if partitioner == PARTITIONER.JUMP:
+        partition_index = get_jump_bucket(
+            get_key_hash(key),
+            len(partition_numbers),
+        )
+    elif partitioner == PARTITIONER.LEGACY:
+        partition_index = get_legacy_partition_index(
+            key,
+            len(partition_numbers),
+        )
     else:
-        value = 0
-        key_hash = string_to_sha3_256(key)
-        for digit in key_hash:
-            value += int(digit, 16)
-        partition_index = value % len(partition_numbers)
-        partition = partition_numbers[partition_index]
-
-    return partition
+        raise ValueError(f'unknown partitioner {partitioner}')
+
+    return partition_numbers[partition_index]
 
 
 def log_dict(